@@ -1,16 +1,18 @@
-import SimpleITK as sitk
-import sitkUtils
 import os
 import getpass
+import hashlib
 import unittest
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import *
 import logging
-import numpy as np
-import string
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import date
 
+# project table columns read or written by the workflow
+TABLE_COLUMNS = ('OBJFile', 'MTLFile', 'TextureDir', 'Status', 'User', 'Date')
+
 #
 # LandmarkFlow
 #
@@ -85,6 +87,11 @@ class CleftLandmarkFlowWidget(ScriptedLoadableModuleWidget):
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
+        # user does not change during the session, look it up once
+        self._user = getpass.getuser()
+        # single logic instance so its caches survive between callbacks
+        self.logic = CleftLandmarkFlowLogic()
+
         # Instantiate and connect widgets ...
         #
         # Input/Export Area
@@ -187,25 +194,17 @@ class CleftLandmarkFlowWidget(ScriptedLoadableModuleWidget):
         self.cleanup()
 
     def updateStatus(self, index, status_string):
-        # refresh table from file, update the status column, and save
-        name = self.fileTable.GetName()
-        slicer.mrmlScene.RemoveNode(self.fileTable)
-        self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
-        self.fileTable.SetLocked(True)
-        self.fileTable.SetName(name)
-        logic = CleftLandmarkFlowLogic()
-        # logic.hideCompletedSamples(self.fileTable)
-        statusColumn = self.fileTable.GetTable().GetColumnByName('Status')
-        statusColumn.SetValue(index - 1, status_string)
+        # update the status columns of the loaded table in place, and save
+        # self.logic.hideCompletedSamples(self.fileTable)
+        with self.logic.tableViewUpdatesPaused():
+            self.tableColumns['Status'].SetValue(index - 1, status_string)
 
-        # set the user to the lab based on an environment variable
-        userColumn = self.fileTable.GetTable().GetColumnByName('User')
-        userColumn.SetValue(index - 1, getpass.getuser())
+            # set the user to the lab based on an environment variable
+            self.tableColumns['User'].SetValue(index - 1, self._user)
 
-        dateColumn = self.fileTable.GetTable().GetColumnByName('Date')
-        dateColumn.SetValue(index - 1, str(date.today()))
+            self.tableColumns['Date'].SetValue(index - 1, date.today().isoformat())
 
-        self.fileTable.GetTable().Modified()  # update table view
+            self.fileTable.GetTable().Modified()  # update table view
         slicer.util.saveNode(self.fileTable, self.tablepath)
 
     def onSelectTablePath(self):
@@ -218,27 +217,31 @@ class CleftLandmarkFlowWidget(ScriptedLoadableModuleWidget):
         if hasattr(self, 'fileTable'):
             slicer.mrmlScene.RemoveNode(self.fileTable)
 
-        with open(self.tableSelector.currentPath, "r") as file:
-            paths = file.read().splitlines()
+        # only the first four lines of the project file are used
+        try:
+            with open(self.tableSelector.currentPath, "r") as file:
+                paths = [next(file).rstrip('\n') for _ in range(4)]
+        except StopIteration:
+            paths = []
 
         if len(paths) >= 4:
             self.tablepath = paths[0]
             self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
-            logic = CleftLandmarkFlowLogic()
-            logic.checkForStatusColumn(self.fileTable,
-                                       paths[0])  # if not present adds and saves to file
+            self.logic.checkForStatusColumn(self.fileTable,
+                                            paths[0])  # if not present adds and saves to file
+            self.tableColumns = self.logic.getTableColumns(self.fileTable)
 
-            with open(paths[1], "r") as file:
-                self.landmarkNames = np.array(file.read().splitlines())
+            self.landmarkNames = Path(paths[1]).read_text().splitlines()
 
             self.imagedir = paths[2]
             self.landmarkdir = paths[3]
 
             self.importVolumeButton.enabled = True
             self.assignLayoutDescription(self.fileTable)
-            # logic.hideCompletedSamples(self.fileTable)
-            self.fileTable.SetLocked(True)
-            self.fileTable.GetTable().Modified()  # update table view
+            with self.logic.tableViewUpdatesPaused():
+                # self.logic.hideCompletedSamples(self.fileTable)
+                self.fileTable.SetLocked(True)
+                self.fileTable.GetTable().Modified()  # update table view
         else:
             msg = qt.QMessageBox()
             msg.setIcon(qt.QMessageBox.Warning)
@@ -250,13 +253,14 @@ class CleftLandmarkFlowWidget(ScriptedLoadableModuleWidget):
             self.importVolumeButton.enabled = False
 
     def onImportMesh(self):
-        logic = CleftLandmarkFlowLogic()
-        self.objpath, mtlpath, texdir = logic.getActiveCell(self.fileTable)
+        logic = self.logic
+        self.objpath, mtlpath, texdir = logic.getActiveCell(self.fileTable, self.tableColumns)
 
         if bool(self.objpath):
 
             print(self.objpath + " " + mtlpath + " " + texdir)
-            self.meshNode, self.textureNode = logic.applyMultiTexture(os.path.join(self.imagedir, self.objpath),
+            self.objFullPath = os.path.join(self.imagedir, self.objpath)
+            self.meshNode, self.textureNode = logic.applyMultiTexture(self.objFullPath,
                                                                       os.path.join(self.imagedir, mtlpath),
                                                                       os.path.join(self.imagedir, texdir))
             if bool(self.meshNode):
@@ -268,14 +272,14 @@ class CleftLandmarkFlowWidget(ScriptedLoadableModuleWidget):
 
                 # fiducials
                 fiducialName = os.path.splitext(self.objpath)[0]
-                fiducialOutput = os.path.join(self.landmarkdir, fiducialName + '.fcsv')
-                print(fiducialOutput)
-                try:
+                self.fiducialOutput = os.path.join(self.landmarkdir, fiducialName + '.fcsv')
+                print(self.fiducialOutput)
+                # first-time landmarking is the common case, check for the file instead of catching the failure
+                if os.path.exists(self.fiducialOutput):
                     print("Loading fiducial")
-                    a = slicer.util.loadMarkupsFiducialList(fiducialOutput)
-                    self.fiducialNode = a[1]
-                except:
-                    print("failed loading fiducial")
+                    self.fiducialNode = slicer.util.loadNodeFromFile(self.fiducialOutput, 'MarkupsFiducials')
+                else:
+                    print("No fiducial file, creating a new one")
                     self.fiducialNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", 'F')
                 # print(self.fiducialNode)
                 # print(self.fiducialNode.GetNumberOfControlPoints())
@@ -298,12 +302,13 @@ class CleftLandmarkFlowWidget(ScriptedLoadableModuleWidget):
 
     def onExportLandmarks(self):
         if hasattr(self, 'fiducialNode'):
-            for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
-                self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
+            # rename under a single modified event, only points whose label differs are touched
+            with slicer.util.NodeModify(self.fiducialNode):
+                for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
+                    if self.fiducialNode.GetNthFiducialLabel(i) != self.landmarkNames[i]:
+                        self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
 
-            fiducialName = os.path.splitext(self.objpath)[0]
-            fiducialOutput = os.path.join(self.landmarkdir, fiducialName + '.fcsv')
-            if slicer.util.saveNode(self.fiducialNode, fiducialOutput):
+            if slicer.util.saveNode(self.fiducialNode, self.fiducialOutput):
                 self.updateTableAndGUI()
             else:
                 msg = qt.QMessageBox()
@@ -331,12 +336,17 @@ class CleftLandmarkFlowWidget(ScriptedLoadableModuleWidget):
     def cleanup(self):
 
         # TODO self.headNodeID etc..
-        if hasattr(self, 'fiducialNode'):
-            slicer.mrmlScene.RemoveNode(self.fiducialNode)
-        if hasattr(self, 'meshNode'):
-            slicer.mrmlScene.RemoveNode(self.meshNode)
-        if hasattr(self, 'textureNode'):
-            slicer.mrmlScene.RemoveNode(self.textureNode)
+        # remove all nodes in one batch so views refresh only once
+        slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+        try:
+            if hasattr(self, 'fiducialNode'):
+                slicer.mrmlScene.RemoveNode(self.fiducialNode)
+            if hasattr(self, 'meshNode'):
+                slicer.mrmlScene.RemoveNode(self.meshNode)
+            if hasattr(self, 'textureNode'):
+                slicer.mrmlScene.RemoveNode(self.textureNode)
+        finally:
+            slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
 
         # self.selectorButton.enabled = bool(self.tablepath)
         self.disableButtons()
@@ -382,20 +392,29 @@ class CleftLandmarkFlowLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
-    def getActiveCell(self, table):
+    def __init__(self):
+        ScriptedLoadableModuleLogic.__init__(self)
+        self.renderWindow = None
+        self.objImporter = None
+        self.vtpExporter = None
+
+    def getTableColumns(self, table):
+        # column arrays by name, GetColumnByName is a linear search so look them up once per table
+        return {name: table.GetTable().GetColumnByName(name) for name in TABLE_COLUMNS}
+
+    def getActiveCell(self, table, columns=None):
         tableView = slicer.app.layoutManager().tableWidget(0).tableView()
         if bool(tableView.selectedIndexes()):
             index = tableView.selectedIndexes()[0]
-            objpath = table.GetTable().GetColumnByName('OBJFile')
-            objpath = objpath.GetValue(index.row() - 1)
-            mtlpath = table.GetTable().GetColumnByName('MTLFile')
-            mtlpath = mtlpath.GetValue(index.row() - 1)
-            texpath = table.GetTable().GetColumnByName('TextureDir')
-            texpath = texpath.GetValue(index.row() - 1)
+            if columns is None:
+                columns = self.getTableColumns(table)
+            objpath = columns['OBJFile'].GetValue(index.row() - 1)
+            mtlpath = columns['MTLFile'].GetValue(index.row() - 1)
+            texpath = columns['TextureDir'].GetValue(index.row() - 1)
             print(objpath + " " + mtlpath + " " + texpath)
             return objpath, mtlpath, texpath
         else:
-            return ""
+            return "", "", ""
 
     def getActiveCellRow(self):
         tableView = slicer.app.layoutManager().tableWidget(0).tableView()
@@ -405,29 +424,50 @@ class CleftLandmarkFlowLogic(ScriptedLoadableModuleLogic):
         else:
             return False
 
+    @contextmanager
+    def tableViewUpdatesPaused(self):
+        """
+        Disable repaints of the table view while the table is changed, repaint once at the end.
+        """
+        tableWidget = slicer.app.layoutManager().tableWidget(0)
+        tableView = tableWidget.tableView() if tableWidget else None
+        if tableView is None or not tableView.updatesEnabled:
+            # no table view shown yet, or an outer block already paused it
+            yield
+            return
+        tableView.setUpdatesEnabled(False)
+        try:
+            yield
+        finally:
+            tableView.setUpdatesEnabled(True)
+            tableView.viewport().update()
+
     def hideCompletedSamples(self, table):
         rowNumber = table.GetNumberOfRows()
         statusColumn = table.GetTable().GetColumnByName('Status')
         tableView = slicer.app.layoutManager().tableWidget(0).tableView()
         if not bool(statusColumn):
             return
-        for currentRow in range(rowNumber):
-            string = statusColumn.GetValue(currentRow)
-            if (string):  # any status should trigger hide row
-                tableView.hideRow(currentRow + 1)
+        # read the column once, then only touch the rows that need hiding
+        values = [statusColumn.GetValue(currentRow) for currentRow in range(rowNumber)]
+        hideRows = [currentRow + 1 for currentRow, val in enumerate(values) if val]  # any status should trigger hide row
+        with self.tableViewUpdatesPaused():
+            for row in hideRows:
+                tableView.hideRow(row)
 
-        table.GetTable().Modified()  # update table view
+            table.GetTable().Modified()  # update table view
 
     def checkForStatusColumn(self, table, tableFilePath):
-        columnNumber = table.GetNumberOfColumns()
-        statusColumn = table.GetTable().GetColumnByName('Status')
-        if not bool(statusColumn):
-            print("Adding column for status")
-            col1 = table.AddColumn()
-            col1.SetName('User')
-            col2 = table.AddColumn()
-            col2.SetName('Status')
-            table.GetTable().Modified()  # update table view
+        # add every column updateStatus writes, so the file is saved here at most once
+        missingColumns = [name for name in ('User', 'Status', 'Date')
+                          if not bool(table.GetTable().GetColumnByName(name))]
+        if missingColumns:
+            print("Adding columns for " + ", ".join(missingColumns))
+            with self.tableViewUpdatesPaused():
+                for name in missingColumns:
+                    col = table.AddColumn()  # initialized with an empty value for every row
+                    col.SetName(name)
+                table.GetTable().Modified()  # update table view
             # Since no files have a status, write to file without reloading
             slicer.util.saveNode(table, tableFilePath)
 
@@ -441,36 +481,72 @@ class CleftLandmarkFlowLogic(ScriptedLoadableModuleLogic):
     def showTextureOnModel(self, modelNode, textureImageNode):
         modelDisplayNode = modelNode.GetDisplayNode()
         modelDisplayNode.SetBackfaceCulling(0)
-        textureImageFlipVert = vtk.vtkImageFlip()
-        textureImageFlipVert.SetFilteredAxis(1)
-        textureImageFlipVert.SetInputConnection(textureImageNode.GetImageDataConnection())
-        modelDisplayNode.SetTextureImageDataConnection(textureImageFlipVert.GetOutputPort())
+        # flip the texture coordinates once instead of flipping the texture image in the pipeline
+        polyData = modelNode.GetPolyData()
+        tcoords = polyData.GetPointData().GetTCoords() if polyData else None
+        if tcoords is not None:
+            tc = numpy_support.vtk_to_numpy(tcoords)
+            tc[:, 1] = 1.0 - tc[:, 1]
+            tcoords.Modified()
+            polyData.Modified()
+        modelDisplayNode.SetTextureImageDataConnection(textureImageNode.GetImageDataConnection())
 
     def applyMultiTexture(self, objPath, mtlPath, texPath, addColorAsPointAttribute=False, colorAsVector=False):
+        if not os.path.isfile(objPath):
+            return None, None
+
         modelNode, textureImageNode = self.OBJtoVTP(objPath, mtlPath, texPath)
         self.applyTexture(modelNode, textureImageNode, addColorAsPointAttribute, colorAsVector)
         return modelNode, textureImageNode
 
+    def meshFileKey(self, objPath, mtlPath, texPath):
+        # the key changes whenever the obj, the mtl or any texture image is replaced or edited
+        paths = [objPath, mtlPath]
+        if os.path.isdir(texPath):
+            paths += sorted(entry.path for entry in os.scandir(texPath) if entry.is_file())
+        fingerprints = []
+        for path in paths:
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                fingerprints.append("%s|%d|%d" % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size))
+            else:
+                fingerprints.append(os.path.abspath(path))
+        return hashlib.blake2b("\n".join(fingerprints).encode("utf-8")).hexdigest()[:16]
+
     def OBJtoVTP(self, objPath, mtlPath, texPath):
-        importer = vtk.vtkOBJImporter()
-        importer.SetFileName(objPath)
-        importer.SetFileNameMTL(mtlPath)
-        importer.SetTexturePath(texPath)
-        importer.Update()
-
-        exporter = vtk.vtkSingleVTPExporter()
-        exporter.SetRenderWindow(importer.GetRenderWindow())
-        # exporter.SetFilePrefix(slicer.app.temporaryPath + os.path.splitext(os.path.basename(objPath))[0])
-        exporter.SetFilePrefix(slicer.app.temporaryPath + os.path.sep + "multi-texture-temp")
-        print(slicer.app.temporaryPath + os.path.sep + "multi-texture-temp")
-        exporter.Write()
-
-        # modelNode = slicer.util.loadModel(slicer.app.temporaryPath + os.path.splitext(os.path.basename(objPath))[0] + ".vtp")
-        modelNode = slicer.util.loadModel(slicer.app.temporaryPath + os.path.sep + "multi-texture-temp.vtp")
-
-        # textureImageNode = slicer.util.loadVolume(slicer.app.temporaryPath + os.path.splitext(os.path.basename(objPath))[0] + ".png", {'singleFile': True})
-        textureImageNode = slicer.util.loadVolume(slicer.app.temporaryPath + os.path.sep + "multi-texture-temp.png",
-                                                  {'singleFile': True})
+        prefix = os.path.join(slicer.app.temporaryPath, "mttex-" + self.meshFileKey(objPath, mtlPath, texPath))
+
+        # the converted files are kept in the temporary folder under a key of the input files,
+        # reopening an unchanged sample skips the conversion
+        if not (os.path.isfile(prefix + ".vtp") and os.path.isfile(prefix + ".png")):
+            # importer, exporter and their render window are reused between imports
+            if self.objImporter is None:
+                # hidden window, its OpenGL context is created once and reused for every import
+                self.renderWindow = vtk.vtkRenderWindow()
+                self.renderWindow.SetOffScreenRendering(1)
+                self.renderWindow.SetSize(1, 1)
+                self.objImporter = vtk.vtkOBJImporter()
+                self.objImporter.SetRenderWindow(self.renderWindow)
+                self.vtpExporter = vtk.vtkSingleVTPExporter()
+            importer = self.objImporter
+            renderer = importer.GetRenderer()
+            if renderer is not None:
+                # drop the previously imported mesh so it is not exported again
+                renderer.RemoveAllViewProps()
+                renderer.RemoveAllLights()
+            importer.SetFileName(objPath)
+            importer.SetFileNameMTL(mtlPath)
+            importer.SetTexturePath(texPath)
+            importer.Update()
+
+            exporter = self.vtpExporter
+            exporter.SetRenderWindow(importer.GetRenderWindow())
+            exporter.SetFilePrefix(prefix)
+            print(prefix)
+            exporter.Write()
+
+        modelNode = slicer.util.loadModel(prefix + ".vtp")
+        textureImageNode = slicer.util.loadVolume(prefix + ".png", {'singleFile': True})
         return modelNode, textureImageNode
 
 
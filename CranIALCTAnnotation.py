@@ -6,6 +6,54 @@ from slicer.ScriptedLoadableModule import *
 import logging
 import numpy as np
 from datetime import date
+from itertools import islice
+from pathlib import Path
+
+# 3D view and slice views on the left, project table on the right
+CUSTOM_LAYOUT_ID = 701
+CUSTOM_LAYOUT = """
+    <layout type=\"horizontal\" split=\"true\" >
+        <item splitSize=\"800\">
+        <layout type=\"vertical\"  split=\"true\" >
+            <item splitSize=\"500\">
+            <view class=\"vtkMRMLViewNode\" singletontag=\"1\">
+            <property name=\"viewlabel\" action=\"default\">1</property>
+            </view>
+            </item>
+            <item splitSize=\"500\">
+            <layout type=\"horizontal\">
+                <item>
+                    <view class=\"vtkMRMLSliceNode\" singletontag=\"Red\">
+                    <property name=\"orientation\" action=\"default\">Axial</property>
+                    <property name=\"viewlabel\" action=\"default\">R</property>
+                    <property name=\"viewcolor\" action=\"default\">#F34A33</property>
+                    </view>
+                </item>
+                <item>
+                    <view class=\"vtkMRMLSliceNode\" singletontag=\"Green\">
+                    <property name=\"orientation\" action=\"default\">Coronal</property>
+                    <property name=\"viewlabel\" action=\"default\">G</property>
+                    <property name=\"viewcolor\" action=\"default\">#6EB04B</property>
+                    </view>
+                </item>
+                <item>
+                    <view class=\"vtkMRMLSliceNode\" singletontag=\"Yellow\">
+                    <property name=\"orientation\" action=\"default\">Sagittal</property>
+                    <property name=\"viewlabel\" action=\"default\">Y</property>
+                    <property name=\"viewcolor\" action=\"default\">#EDD54C</property>
+                    </view>
+                </item>
+            </layout>
+            </item>
+        </layout>
+        </item>
+        <item splitSize=\"200\">
+        <view class=\"vtkMRMLTableViewNode\" singletontag=\"TableView1\">
+        <property name=\"viewlabel\" action=\"default\">T</property>
+        </view>
+        </item>
+    </layout>
+"""
 
 #
 # CranIALCTAnnotation
@@ -52,57 +100,13 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
     """
 
     def assignLayoutDescription(self, table):
-        customLayout = """
-    <layout type=\"horizontal\" split=\"true\" >
-        <item splitSize=\"800\">
-        <layout type=\"vertical\"  split=\"true\" >
-            <item splitSize=\"500\">
-            <view class=\"vtkMRMLViewNode\" singletontag=\"1\">
-            <property name=\"viewlabel\" action=\"default\">1</property>
-            </view>
-            </item>
-            <item splitSize=\"500\">
-            <layout type=\"horizontal\">
-                <item>
-                    <view class=\"vtkMRMLSliceNode\" singletontag=\"Red\">
-                    <property name=\"orientation\" action=\"default\">Axial</property>
-                    <property name=\"viewlabel\" action=\"default\">R</property>
-                    <property name=\"viewcolor\" action=\"default\">#F34A33</property>
-                    </view>
-                </item>
-                <item>
-                    <view class=\"vtkMRMLSliceNode\" singletontag=\"Green\">
-                    <property name=\"orientation\" action=\"default\">Coronal</property>
-                    <property name=\"viewlabel\" action=\"default\">G</property>
-                    <property name=\"viewcolor\" action=\"default\">#6EB04B</property>
-                    </view>
-                </item>
-                <item>
-                    <view class=\"vtkMRMLSliceNode\" singletontag=\"Yellow\">
-                    <property name=\"orientation\" action=\"default\">Sagittal</property>
-                    <property name=\"viewlabel\" action=\"default\">Y</property>
-                    <property name=\"viewcolor\" action=\"default\">#EDD54C</property>
-                    </view>
-                </item>
-            </layout>
-            </item>
-        </layout>
-        </item>
-        <item splitSize=\"200\">
-        <view class=\"vtkMRMLTableViewNode\" singletontag=\"TableView1\">
-        <property name=\"viewlabel\" action=\"default\">T</property>
-        </view>
-        </item>
-    </layout>
-    """
-
-        customLayoutId = 701
-
         layoutManager = slicer.app.layoutManager()
-        layoutManager.layoutLogic().GetLayoutNode().AddLayoutDescription(customLayoutId, customLayout)
+        layoutNode = layoutManager.layoutLogic().GetLayoutNode()
+        if not layoutNode.IsLayoutDescription(CUSTOM_LAYOUT_ID):
+            layoutNode.AddLayoutDescription(CUSTOM_LAYOUT_ID, CUSTOM_LAYOUT)
 
         # Switch to the new custom layout
-        layoutManager.setLayout(customLayoutId)
+        layoutManager.setLayout(CUSTOM_LAYOUT_ID)
 
         # Select table in viewer
         slicer.app.applicationLogic().GetSelectionNode().SetReferenceActiveTableID(table.GetID())
@@ -111,6 +115,28 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
+        self._user = getpass.getuser()
+        self.logic = CranIALCTAnnotationLogic()
+
+        self.threeDView = None
+        slicer.app.layoutManager().connect('layoutChanged(int)', self.onLayoutChanged)
+
+        # nodes and subject hierarchy folders created for the current sample, removed in cleanup
+        self.sampleNodes = []
+        self.exportFolderItemIds = []
+
+        self.tableSaveTimer = qt.QTimer()
+        self.tableSaveTimer.setSingleShot(True)
+        self.tableSaveTimer.setInterval(2000)
+        self.tableSaveTimer.connect('timeout()', self.saveTable)
+        slicer.app.connect('aboutToQuit()', self.flushTable)
+        self.sceneCloseObserverTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.StartCloseEvent,
+                                                                  self.onSceneStartClose)
+
+        # render CT volumes on the GPU, the CPU ray caster is not interactive for these sizes
+        slicer.modules.volumerendering.logic().SetDefaultRenderingMethod(
+            "vtkMRMLGPURayCastVolumeRenderingDisplayNode")
+
         # 3D render presets
         self.softTissueVP = slicer.util.loadNodeFromFile(self.resourcePath("CT-SoftTissue.vp"),
                                                          "TransferFunctionFile")
@@ -314,19 +340,30 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
         self.layout.addWidget(self.skipButton)
         self.layout.addStretch(1)
 
+        # buttons that are only usable while a sample is loaded
+        self.sampleButtons = (self.markIncompleteButton, self.exportLandmarksButton, self.boneWindow,
+                              self.softTissueWindow, self.boneRender, self.boneRender2, self.softTissueRender,
+                              self.removeNoiseButton, self.removeTubeButton, self.originalVolumeButton,
+                              self.frankfortAlignment, self.frankfortAlignmentR, self.oSeAlignment,
+                              self.oNaAlignment, self.skipButton, self.startSegmentationButton,
+                              self.exportSegmentationButton)
+
     def onImportVolume(self):
-        logic = CranIALCTAnnotationLogic()
-        self.activeCellString = logic.getActiveCell()
+        activeRow, self.activeCellString = self.logic.getActiveSelection()
         if bool(self.activeCellString):
             volumePath = os.path.join(self.imagedir, self.activeCellString)
+            # loading has to stay on the main thread (MRML is not thread safe), keep the GUI painting instead
+            progress = slicer.util.createProgressDialog(labelText="Loading volume", maximum=3)
+            slicer.app.processEvents()
             try:
                 print("Loading volume")
                 self.volumeNode = slicer.util.loadVolume(volumePath, {'singleFile': True})
             except:
+                progress.close()
                 msg = qt.QMessageBox()
                 msg.setIcon(qt.QMessageBox.Warning)
                 msg.setText(
-                    "Image \"" + logic.getActiveCell() + "\" is not in folder \"" + self.imagedir + ".")
+                    "Image \"" + self.activeCellString + "\" is not in folder \"" + self.imagedir + ".")
                 msg.setWindowTitle("Image cannot be loaded")
                 msg.setStandardButtons(qt.QMessageBox.Ok)
                 msg.exec_()
@@ -334,15 +371,29 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
             if bool(self.volumeNode):
 
                 sampleName = self.volumeNode.GetName()
-                self.activeRow = logic.getActiveCellRow()
+                # landmark and segmentation files of the sample share this prefix
+                self.samplePathPrefix = os.path.join(self.landmarkdir, sampleName)
+                self.activeRow = activeRow
                 # self.updateStatus(self.activeRow, 'Processing') # TODO uncomment this
 
+                # bone and soft tissue window/level, applied in a single update by preset index
+                displayNode = self.volumeNode.GetDisplayNode()
+                displayNode.AutoWindowLevelOff()
+                # the volume may bring presets of its own, ours are added after them
+                self.boneWindowPreset = displayNode.GetNumberOfWindowLevelPresets()
+                self.softTissueWindowPreset = self.boneWindowPreset + 1
+                displayNode.AddWindowLevelPreset(1000, 400)
+                displayNode.AddWindowLevelPreset(100, 50)
                 self.onBoneWindow()
                 slicer.util.resetSliceViews()
-                self.render3d(self.volumeNode)
+                self.volumeRenderingDisplay = self.render3d(self.volumeNode)
+                self.centerThreeDView()
 
                 # fiducials
-                fiducialPath = os.path.join(self.landmarkdir, sampleName + '.fcsv')
+                progress.labelText = "Loading landmarks"
+                progress.value = 1
+                slicer.app.processEvents()
+                fiducialPath = self.samplePathPrefix + '.fcsv'
                 try:
                     print("Loading fiducial " + fiducialPath)
                     a = slicer.util.loadMarkupsFiducialList(fiducialPath)
@@ -352,7 +403,10 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
                     self.fiducialNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", sampleName)
 
                 # segmentation
-                segmentationPath = os.path.join(self.landmarkdir, sampleName + '.seg.nrrd')
+                progress.labelText = "Loading segmentation"
+                progress.value = 2
+                slicer.app.processEvents()
+                segmentationPath = self.samplePathPrefix + '.seg.nrrd'
                 try:
                     print("Loading segmentation" + segmentationPath)
                     self.segmentationNode = slicer.util.loadSegmentation(segmentationPath)
@@ -363,195 +417,116 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
                     self.segmentationNode.CreateDefaultDisplayNodes()  # only needed for display
                     self.segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(self.volumeNode)
 
-                self.maskedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
-                                                                       sampleName + "_masked")
-                self.maskedVolume.CopyContent(self.volumeNode)
-                self.render3d(self.maskedVolume)
-                self.turnOffRender(self.maskedVolume)
-
-                # Transformation
-                matrix = vtk.vtkMatrix4x4()
-                matrix.Identity()
-                transform = vtk.vtkTransform()
-                transform.SetMatrix(matrix)
-                self.transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode', 'Alignment Transform')
-                self.transformNode.SetAndObserveTransformToParent(transform)
-
-                self.volumeNode.SetAndObserveTransformNodeID(self.transformNode.GetID())
-                self.maskedVolume.SetAndObserveTransformNodeID(self.transformNode.GetID())
-                self.fiducialNode.SetAndObserveTransformNodeID(self.transformNode.GetID())
-                self.segmentationNode.SetAndObserveTransformNodeID(self.transformNode.GetID())
-                self.turnOnRender(self.volumeNode)
+                # masked volume is only created once tube or noise removal is run
+                self.maskedVolume = None
+
+                # Transformation, applied in one scene update
+                slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+                try:
+                    transform = vtk.vtkTransform()  # identity by default
+                    self.transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode',
+                                                                            'Alignment Transform')
+                    self.transformNode.SetAndObserveTransformToParent(transform)
+
+                    for node in (self.volumeNode, self.fiducialNode, self.segmentationNode):
+                        node.SetAndObserveTransformNodeID(self.transformNode.GetID())
+                    self.sampleNodes += [self.volumeNode, self.fiducialNode, self.segmentationNode,
+                                         self.transformNode]
+                    self.turnOnRender(self.volumeNode)
+                finally:
+                    slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
 
                 self.enableButtons()
+            progress.close()
 
         else:
             logging.debug("No valid table cell selected.")
 
+    def ensureMaskedVolume(self):
+        if self.maskedVolume is None:
+            self.maskedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
+                                                                   self.volumeNode.GetName() + "_masked")
+            self.maskedVolume.CopyContent(self.volumeNode)
+            self.maskedRenderingDisplay = self.render3d(self.maskedVolume)
+            # render3d sets the bone preset, the masked volume has to look like the original one does now
+            self.maskedRenderingDisplay.GetVolumePropertyNode().Copy(
+                self.volumeRenderingDisplay.GetVolumePropertyNode())
+            self.turnOffRender(self.maskedVolume)
+            self.maskedVolume.SetAndObserveTransformNodeID(self.transformNode.GetID())
+            self.sampleNodes.append(self.maskedVolume)
+        return self.maskedVolume
+
     def onOriginalVolume(self):
-        self.turnOffRender(self.maskedVolume)
+        if self.maskedVolume is not None:
+            self.turnOffRender(self.maskedVolume)
         self.turnOnRender(self.volumeNode)
 
     def onBoneWindow(self):
         # Set window/level of the volume to bone
-        displayNode = self.volumeNode.GetDisplayNode()
-        displayNode.AutoWindowLevelOff()
-        displayNode.SetWindow(1000)
-        displayNode.SetLevel(400)
+        self.volumeNode.GetDisplayNode().SetWindowLevelFromPreset(self.boneWindowPreset)
 
     def onSoftTissueWindow(self):
-        # Set window/level of the volume to bone
-        displayNode = self.volumeNode.GetDisplayNode()
-        displayNode.AutoWindowLevelOff()
-        displayNode.SetWindow(100)
-        displayNode.SetLevel(50)
+        # Set window/level of the volume to soft tissue
+        self.volumeNode.GetDisplayNode().SetWindowLevelFromPreset(self.softTissueWindowPreset)
 
     def onBoneRender(self):
-        volRenLogic = slicer.modules.volumerendering.logic()
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode).GetVolumePropertyNode().Copy(self.boneVP)
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(self.boneVP)
+        self.setVolumeProperty(self.boneVP)
 
     def onBoneRender2(self):
-        volRenLogic = slicer.modules.volumerendering.logic()
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode).GetVolumePropertyNode().Copy(self.boneVP2)
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(self.boneVP2)
+        self.setVolumeProperty(self.boneVP2)
 
     def onSoftTissueRender(self):
-        # Set window/level of the volume to bone
-        volRenLogic = slicer.modules.volumerendering.logic()
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode).GetVolumePropertyNode().Copy(
-            self.softTissueVP)
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(
-            self.softTissueVP)
-
-    def nameFiducials(self):
-        for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
-            self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
-
-    def onFrankfort(self):
-
-        self.nameFiducials()
-        logic = CranIALCTAnnotationLogic()
+        self.setVolumeProperty(self.softTissueVP)
 
-        zyoL_id = np.where(self.landmarkNames == "zyoL")[0][0]
-        poR_id = np.where(self.landmarkNames == "poR")[0][0]
-        poL_id = np.where(self.landmarkNames == "poL")[0][0]
+    def setVolumeProperty(self, volumePropertyNode):
+        # copy into the display's own property node, edits in the Volume Rendering module must not change the preset
+        self.volumeRenderingDisplay.GetVolumePropertyNode().Copy(volumePropertyNode)
+        if self.maskedVolume is not None:
+            self.maskedRenderingDisplay.GetVolumePropertyNode().Copy(volumePropertyNode)
 
-        if (self.fiducialNode.GetNumberOfFiducials() <= zyoL_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poL_id):
-            msg = qt.QMessageBox()
-            msg.setIcon(qt.QMessageBox.Warning)
-            msg.setText("All necessary landmarks not marked yet")
-            msg.setWindowTitle("Missing landmark")
-            msg.setStandardButtons(qt.QMessageBox.Ok)
-            msg.exec_()
-            logging.debug("Error loading associated files.")
-            return
-
-        poR = [0, 0, 0]
-        poL = [0, 0, 0]
-        zyoL = [0, 0, 0]
-
-        self.fiducialNode.GetNthFiducialPosition(poR_id, poR)
-        self.fiducialNode.GetNthFiducialPosition(poL_id, poL)
-        self.fiducialNode.GetNthFiducialPosition(zyoL_id, zyoL)
-        mat = logic.getFrankfortAlignment(poR, poL, zyoL)
+    def getLandmarkIds(self, names):
+        # indices of the named landmarks in the landmark list
+        return tuple(self.landmarkIdx[name] for name in names)
 
-        self.transformNode.SetAndObserveMatrixTransformToParent(mat)
+    def getLandmarkPositions(self, ids):
+        # positions of the given control points, fetched from the markups node in one call
+        return slicer.util.arrayFromMarkupsControlPoints(self.fiducialNode)[list(ids)].tolist()
 
-        self.resetViews()
+    def nameFiducials(self):
+        # relabel under a single modified event, only points whose label differs are touched
+        with slicer.util.NodeModify(self.fiducialNode):
+            for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
+                if self.fiducialNode.GetNthControlPointLabel(i) != self.landmarkNames[i]:
+                    self.fiducialNode.SetNthControlPointLabel(i, self.landmarkNames[i])
 
-        print("Frankfort Alignment")
+    def onFrankfort(self):
+        self.runAlignment(("poR", "poL", "zyoL"), self.logic.getFrankfortAlignment)
+        logging.debug("Frankfort Alignment")
 
     def onFrankfort2(self):
-
-        self.nameFiducials()
-        logic = CranIALCTAnnotationLogic()
-
-        zyoR_id = np.where(self.landmarkNames == "zyoR")[0][0]
-        poR_id = np.where(self.landmarkNames == "poR")[0][0]
-        poL_id = np.where(self.landmarkNames == "poL")[0][0]
-
-        if (self.fiducialNode.GetNumberOfFiducials() <= zyoR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poL_id):
-            msg = qt.QMessageBox()
-            msg.setIcon(qt.QMessageBox.Warning)
-            msg.setText("All necessary landmarks not marked yet")
-            msg.setWindowTitle("Missing landmark")
-            msg.setStandardButtons(qt.QMessageBox.Ok)
-            msg.exec_()
-            logging.debug("Error loading associated files.")
-            return
-
-        poR = [0, 0, 0]
-        poL = [0, 0, 0]
-        zyoR = [0, 0, 0]
-
-        self.fiducialNode.GetNthFiducialPosition(poR_id, poR)
-        self.fiducialNode.GetNthFiducialPosition(poL_id, poL)
-        self.fiducialNode.GetNthFiducialPosition(zyoR_id, zyoR)
-        mat = logic.getFrankfortAlignment(poR, poL, zyoR)
-
-        self.transformNode.SetAndObserveMatrixTransformToParent(mat)
-
-        self.resetViews()
-
-        print("Frankfort Alignment right")
+        self.runAlignment(("poR", "poL", "zyoR"), self.logic.getFrankfortAlignment)
+        logging.debug("Frankfort Alignment right")
 
     def onOSeaAlignment(self):
-
-        self.nameFiducials()
-        logic = CranIALCTAnnotationLogic()
-
-        o_id = np.where(self.landmarkNames == "o")[0][0]
-        se_id = np.where(self.landmarkNames == "se")[0][0]
-        poR_id = np.where(self.landmarkNames == "poR")[0][0]
-        poL_id = np.where(self.landmarkNames == "poL")[0][0]
-
-        if (self.fiducialNode.GetNumberOfFiducials() <= se_id) | (self.fiducialNode.GetNumberOfFiducials() <= o_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poL_id):
-            msg = qt.QMessageBox()
-            msg.setIcon(qt.QMessageBox.Warning)
-            msg.setText("All necessary landmarks not marked yet")
-            msg.setWindowTitle("Missing landmark")
-            msg.setStandardButtons(qt.QMessageBox.Ok)
-            msg.exec_()
-            logging.debug("Error loading associated files.")
-            return
-
-        poR = [0, 0, 0]
-        poL = [0, 0, 0]
-        se = [0, 0, 0]
-        o = [0, 0, 0]
-
-        self.fiducialNode.GetNthFiducialPosition(poR_id, poR)
-        self.fiducialNode.GetNthFiducialPosition(poL_id, poL)
-        self.fiducialNode.GetNthFiducialPosition(se_id, se)
-        self.fiducialNode.GetNthFiducialPosition(o_id, o)
-        mat = logic.getOSeAlignment(poR, poL, se, o)
-
-        self.transformNode.SetAndObserveMatrixTransformToParent(mat)
-
-        self.resetViews()
-
-        print("O-Se Alignment")
+        self.runAlignment(("poR", "poL", "se", "o"), self.logic.getOSeAlignment)
+        logging.debug("O-Se Alignment")
 
     def onONaAlignment(self):
+        self.runAlignment(("poR", "poL", "n", "o"), self.logic.getOSeAlignment)
+        logging.debug("O-Na Alignment")
 
+    def runAlignment(self, names, getAlignment):
+        # align the scene with the matrix computed from the named landmarks, passed in the given order
         self.nameFiducials()
-        logic = CranIALCTAnnotationLogic()
 
-        o_id = np.where(self.landmarkNames == "o")[0][0]
-        na_id = np.where(self.landmarkNames == "n")[0][0]
-        poR_id = np.where(self.landmarkNames == "poR")[0][0]
-        poL_id = np.where(self.landmarkNames == "poL")[0][0]
+        try:
+            ids = self.getLandmarkIds(names)
+            missing = max(ids) >= self.fiducialNode.GetNumberOfFiducials()
+        except KeyError:
+            # the landmark name file does not list one of the landmarks
+            missing = True
 
-        if (self.fiducialNode.GetNumberOfFiducials() <= na_id) | (self.fiducialNode.GetNumberOfFiducials() <= o_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poL_id):
+        if missing:
             msg = qt.QMessageBox()
             msg.setIcon(qt.QMessageBox.Warning)
             msg.setText("All necessary landmarks not marked yet")
@@ -561,31 +536,19 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
             logging.debug("Error loading associated files.")
             return
 
-        poR = [0, 0, 0]
-        poL = [0, 0, 0]
-        na = [0, 0, 0]
-        o = [0, 0, 0]
-
-        self.fiducialNode.GetNthFiducialPosition(poR_id, poR)
-        self.fiducialNode.GetNthFiducialPosition(poL_id, poL)
-        self.fiducialNode.GetNthFiducialPosition(na_id, na)
-        self.fiducialNode.GetNthFiducialPosition(o_id, o)
-        mat = logic.getOSeAlignment(poR, poL, na, o)
+        mat = getAlignment(*self.getLandmarkPositions(ids))
 
-        self.transformNode.SetAndObserveMatrixTransformToParent(mat)
+        self.transformNode.SetMatrixTransformToParent(mat)
 
         self.resetViews()
 
-        print("O-Na Alignment")
-
     def onMarkIncomplete(self):
         # TODO ask for a reason, maybe a text box?
         self.updateTableAndGUI(False)
 
     def onRemoveTube(self):
 
-        logic = CranIALCTAnnotationLogic()
-        logic.removeTube(self.segmentationNode, self.volumeNode, self.maskedVolume)
+        self.logic.removeTube(self.segmentationNode, self.volumeNode, self.ensureMaskedVolume())
 
         self.turnOffRender(self.volumeNode)
         self.turnOnRender(self.maskedVolume)
@@ -593,8 +556,7 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
 
     def onRemoveNoise(self):
 
-        logic = CranIALCTAnnotationLogic()
-        logic.removeNoise(self.segmentationNode, self.volumeNode, self.maskedVolume)
+        self.logic.removeNoise(self.segmentationNode, self.volumeNode, self.ensureMaskedVolume())
 
         self.turnOffRender(self.volumeNode)
         self.turnOnRender(self.maskedVolume)
@@ -602,17 +564,17 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
 
     def onStartSegmentation(self):
 
-        logic = CranIALCTAnnotationLogic()
-        logic.initializeSegmentation(self.segmentationNode, self.volumeNode)
-        self.turnOffRender(self.maskedVolume)
+        self.logic.initializeSegmentation(self.segmentationNode, self.volumeNode)
+        if self.maskedVolume is not None:
+            self.turnOffRender(self.maskedVolume)
         self.turnOffRender(self.volumeNode)
 
         slicer.util.selectModule(slicer.modules.segmenteditor)
-        # editor = slicer.util.getNode("SegmentEditor_1")
-        slicer.modules.segmenteditor.widgetRepresentation().self().editor.setSegmentationNode(self.segmentationNode)
+        editor = slicer.modules.segmenteditor.widgetRepresentation().self().editor
+        editor.setSegmentationNode(self.segmentationNode)
 
-        # TODO how to get SegmentEditor
-        segmentEditor = slicer.mrmlScene.GetNodesByClass("vtkMRMLSegmentEditorNode").GetItemAsObject(0)
+        # parameter node of the editor widget itself, no scene search
+        segmentEditor = editor.mrmlSegmentEditorNode()
         segmentEditor.SetSelectedSegmentID("Intraop Material")
         segmentEditor.SetOverwriteMode(2)
         segmentEditor.SetMasterVolumeIntensityMask(1)
@@ -623,14 +585,24 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
         if self.segmentationNode is not None:
             shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
             exportFolderItemId = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Segments")
-            slicer.modules.segmentations.logic().ExportAllSegmentsToModels(self.segmentationNode, exportFolderItemId)
-
-            if slicer.util.saveNode(self.segmentationNode,
-                                    os.path.join(self.landmarkdir, self.segmentationNode.GetName() + ".seg.nrrd")) and \
-                    slicer.util.saveNode(slicer.util.getNode("bone"), os.path.join(self.landmarkdir,
-                                                                                   self.segmentationNode.GetName() + ".bone.ply")) and \
-                    slicer.util.saveNode(slicer.util.getNode("Intraop Material"), os.path.join(self.landmarkdir,
-                                                                                               self.segmentationNode.GetName() + ".material.ply")):
+            self.exportFolderItemIds.append(exportFolderItemId)
+            # only the bone and material surfaces are saved, skip building a model for the head segment
+            segmentation = self.segmentationNode.GetSegmentation()
+            segmentIds = vtk.vtkStringArray()
+            for segmentName in ("bone", "Intraop Material"):
+                segmentIds.InsertNextValue(segmentation.GetSegmentIdBySegmentName(segmentName))
+            slicer.modules.segmentations.logic().ExportSegmentsToModels(self.segmentationNode, segmentIds,
+                                                                        exportFolderItemId)
+            models = self.logic.getExportedModels(exportFolderItemId)
+
+            # attempt every file even if an earlier one fails
+            outputs = ((self.segmentationNode, ".seg.nrrd"),
+                       (models["bone"], ".bone.ply"),
+                       (models["Intraop Material"], ".material.ply"))
+            saved = [slicer.util.saveNode(node, self.samplePathPrefix + extension)
+                     for node, extension in outputs]
+
+            if all(saved):
 
                 self.updateTableAndGUI("Segmentation")
 
@@ -647,28 +619,6 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
         # TODO ask for a reason, maybe a text box?
         self.cleanup()
 
-    def updateStatus(self, index, status_string):
-        # refresh table from file, update the status column, and save
-        name = self.fileTable.GetName()
-        slicer.mrmlScene.RemoveNode(self.fileTable)
-        self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
-        self.fileTable.SetLocked(True)
-        self.fileTable.SetName(name)
-        logic = CranIALCTAnnotationLogic()
-        # logic.hideCompletedSamples(self.fileTable)
-        statusColumn = self.fileTable.GetTable().GetColumnByName('Status')
-        statusColumn.SetValue(index - 1, status_string)
-
-        # set the user to the lab based on an environment variable
-        userColumn = self.fileTable.GetTable().GetColumnByName('User')
-        userColumn.SetValue(index - 1, getpass.getuser())
-
-        dateColumn = self.fileTable.GetTable().GetColumnByName('Date')
-        dateColumn.SetValue(index - 1, str(date.today()))
-
-        self.fileTable.GetTable().Modified()  # update table view
-        slicer.util.saveNode(self.fileTable, self.tablepath)
-
     def onSelectTablePath(self):
         if (self.tableSelector.currentPath):
             self.selectorButton.enabled = True
@@ -677,17 +627,23 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
 
     def onLoadProject(self):
         if hasattr(self, 'fileTable'):
+            self.flushTable()
             slicer.mrmlScene.RemoveNode(self.fileTable)
 
+        # only the first four lines are used
         with open(self.tableSelector.currentPath, "r") as file:
-            paths = file.read().splitlines()
+            paths = [line.rstrip("\r\n") for line in islice(file, 4)]
 
         if len(paths) >= 4:
             self.tablepath = paths[0]
             self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
+            self.tableMtime = os.path.getmtime(self.tablepath)
 
-            with open(paths[1], "r") as file:
-                self.landmarkNames = np.array(file.read().splitlines())
+            self.landmarkNames = Path(paths[1]).read_text().splitlines()
+            # first index of every landmark name, for constant time lookups
+            self.landmarkIdx = {}
+            for i, name in enumerate(self.landmarkNames):
+                self.landmarkIdx.setdefault(name, i)
 
             self.imagedir = paths[2]
             self.landmarkdir = paths[3]
@@ -709,11 +665,14 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
 
     def onExportLandmarks(self):
         if hasattr(self, 'fiducialNode'):
-            for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
-                self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
-
-            fiducialPath = os.path.join(self.landmarkdir, self.fiducialNode.GetName() + '.fcsv')
-            if slicer.util.saveNode(self.fiducialNode, fiducialPath):
+            self.nameFiducials()
+
+            fiducialPath = self.samplePathPrefix + '.fcsv'
+            # the file already holds these landmarks when the node is unchanged since it was read or saved there
+            storageNode = self.fiducialNode.GetStorageNode()
+            unchanged = storageNode is not None and storageNode.GetFileName() == fiducialPath and \
+                not self.fiducialNode.GetModifiedSinceRead()
+            if unchanged or slicer.util.saveNode(self.fiducialNode, fiducialPath):
                 self.updateTableAndGUI("Landmark")
             else:
                 msg = qt.QMessageBox()
@@ -739,132 +698,122 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
         # self.exportSegmentationButton.enabled = False
 
     def updateStatus(self, index, statusColumName, status_string):
-        # refresh table from file, update the status column, and save
-        name = self.fileTable.GetName()
-        slicer.mrmlScene.RemoveNode(self.fileTable)
-        self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
-        self.fileTable.SetLocked(True)
-        self.fileTable.SetName(name)
-        # logic = MandibleNerveFlowLogic()
-        # logic.hideCompletedSamples(self.fileTable)
-        statusColumn = self.fileTable.GetTable().GetColumnByName(statusColumName)
-        statusColumn.SetValue(index - 1,
-                              status_string + "," + getpass.getuser() + "," + str(date.today()))
-
-        self.fileTable.GetTable().Modified()  # update table view
-        print(self.tablepath)
-        slicer.util.saveNode(self.fileTable, self.tablepath)
+        # update the status column of the loaded table in place, the file is saved by tableSaveTimer
+        with slicer.util.NodeModify(self.fileTable):
+            statusColumn = self.fileTable.GetTable().GetColumnByName(statusColumName)
+            statusColumn.SetValue(index - 1,
+                                  status_string + "," + self._user + "," + date.today().isoformat())
+
+            self.fileTable.GetTable().Modified()  # update table view
+        # consecutive edits are written together once the timer runs out
+        self.tableSaveTimer.start()
+
+    def saveTable(self):
+        self.tableSaveTimer.stop()
+        logging.debug("Saving table %s", self.tablepath)
+        # events from the storage node update are delivered once the save is done
+        with slicer.util.NodeModify(self.fileTable):
+            slicer.util.saveNode(self.fileTable, self.tablepath)
+        self.tableMtime = os.path.getmtime(self.tablepath)
+
+    def flushTable(self):
+        # write pending status edits before the table file is read or the table is replaced
+        if self.tableSaveTimer.isActive():
+            self.saveTable()
+
+    def onSceneStartClose(self, caller, event):
+        self.flushTable()
+
+    def onReload(self):
+        # this widget is replaced, nothing of it may fire once the module is reloaded
+        self.flushTable()
+        slicer.mrmlScene.RemoveObserver(self.sceneCloseObserverTag)
+        slicer.app.disconnect('aboutToQuit()', self.flushTable)
+        slicer.app.layoutManager().disconnect('layoutChanged(int)', self.onLayoutChanged)
+        ScriptedLoadableModuleWidget.onReload(self)
+
+    def reloadTableIfChanged(self):
+        # re-read the table only when the file was written since it was loaded or saved here
+        if os.path.getmtime(self.tablepath) > self.tableMtime:
+            name = self.fileTable.GetName()
+            slicer.mrmlScene.RemoveNode(self.fileTable)
+            self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
+            self.fileTable.SetLocked(True)
+            self.fileTable.SetName(name)
+            self.tableMtime = os.path.getmtime(self.tablepath)
 
     def checkAndCleanup(self, index):
-        name = self.fileTable.GetName()
-        slicer.mrmlScene.RemoveNode(self.fileTable)
-        self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
-        self.fileTable.SetLocked(True)
-        self.fileTable.SetName(name)
+        self.flushTable()
+        self.reloadTableIfChanged()
 
-        if (self.fileTable.GetTable().GetColumnByName("Segmentation").GetValue(index - 1) is not ""):
+        if (self.fileTable.GetTable().GetColumnByName("Segmentation").GetValue(index - 1) != ""):
             self.cleanup()
 
     def cleanup(self):
+        # pending status edits are written before the sample, or the whole widget, goes away
+        self.flushTable()
 
-        if hasattr(self, 'fiducialNode'):
-            slicer.mrmlScene.RemoveNode(self.fiducialNode)
-        if hasattr(self, 'volumeNode'):
-            slicer.mrmlScene.RemoveNode(self.volumeNode)
-        if hasattr(self, 'maskedVolume'):
-            slicer.mrmlScene.RemoveNode(self.maskedVolume)
-        if hasattr(self, 'segmentationNode'):
-            slicer.mrmlScene.RemoveNode(self.segmentationNode)
-        if hasattr(self, 'labelMap'):
-            slicer.mrmlScene.RemoveNode(self.labelMap)
-        if hasattr(self, 'transformNode'):
-            slicer.mrmlScene.RemoveNode(self.transformNode)
-        if hasattr(self, 'cleaningSegmentation'):
-            slicer.mrmlScene.RemoveNode(self.cleaningSegmentation)
-        # if hasattr(self, 'segmentEditorNode'):
-        #     slicer.mrmlScene.RemoveNode(self.segmentEditorNode)
-        if hasattr(self, 'planeNode'):
-            slicer.mrmlScene.RemoveNode(self.planeNode)
-
+        slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+        try:
+            # exported segment models are removed with their folder
+            shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+            for itemId in self.exportFolderItemIds:
+                shNode.RemoveItem(itemId)
+            for node in self.sampleNodes:
+                slicer.mrmlScene.RemoveNode(node)
+        finally:
+            slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+        self.exportFolderItemIds = []
+        self.sampleNodes = []
+
+        self.maskedVolume = None
         self.headSegmentID = None
         self.skullSegmentId = None
         self.segmentationNode = None
         self.planeNode = None
 
-        annotationROIs = slicer.mrmlScene.GetNodesByClass("vtkMRMLAnnotationROINode")
-        for roi in annotationROIs:
-            slicer.mrmlScene.RemoveNode(roi)
-
-        shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-        shNode.RemoveItem(shNode.GetItemByName("Segments"))
-        segments = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
-        for segment in segments:
-            slicer.mrmlScene.RemoveNode(segment)
-
-        vps = slicer.mrmlScene.GetNodesByClass("vtkMRMLVolumePropertyNode")
-        for vp in vps:
-            slicer.mrmlScene.RemoveNode(vp)
-
         self.disableButtons()
 
     def enableButtons(self):
-        self.markIncompleteButton.enabled = True
-        self.exportLandmarksButton.enabled = True
-        self.boneWindow.enabled = True
-        self.softTissueWindow.enabled = True
-        self.boneRender.enabled = True
-        self.boneRender2.enabled = True
-        self.softTissueRender.enabled = True
-        self.removeNoiseButton.enabled = True
-        self.removeTubeButton.enabled = True
-        self.originalVolumeButton.enabled = True
-        self.frankfortAlignment.enabled = True
-        self.frankfortAlignmentR.enabled = True
-        self.oSeAlignment.enabled = True
-        self.oNaAlignment.enabled = True
-        self.skipButton.enabled = True
-        self.importVolumeButton.enabled = False
-
-        self.startSegmentationButton.enabled = True
-        self.exportSegmentationButton.enabled = True
+        self.setSampleButtonsEnabled(True)
 
     def disableButtons(self):
-        self.markIncompleteButton.enabled = False
-        self.exportLandmarksButton.enabled = False
-        self.boneWindow.enabled = False
-        self.softTissueWindow.enabled = False
-        self.boneRender.enabled = False
-        self.boneRender2.enabled = False
-        self.softTissueRender.enabled = False
-        self.removeNoiseButton.enabled = False
-        self.removeTubeButton.enabled = False
-        self.originalVolumeButton.enabled = False
-        self.frankfortAlignment.enabled = False
-        self.frankfortAlignmentR.enabled = False
-        self.oSeAlignment.enabled = False
-        self.oNaAlignment.enabled = False
-        self.skipButton.enabled = False
-        self.importVolumeButton.enabled = True
+        self.setSampleButtonsEnabled(False)
 
-        self.startSegmentationButton.enabled = False
-        self.exportSegmentationButton.enabled = False
+    def setSampleButtonsEnabled(self, enabled):
+        # repaint the panel once after all buttons are toggled
+        parent = self.layout.parentWidget()
+        parent.setUpdatesEnabled(False)
+        for button in self.sampleButtons:
+            button.enabled = enabled
+        self.importVolumeButton.enabled = not enabled
+        parent.setUpdatesEnabled(True)
 
     def render3d(self, volumeNode):
         # 3D render volume
         volRenLogic = slicer.modules.volumerendering.logic()
         displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(volumeNode)
+        # fixed quality, adaptive quality is unreliable with GPU ray casting
+        slicer.app.layoutManager().threeDWidget(0).mrmlViewNode().SetVolumeRenderingQuality(
+            slicer.vtkMRMLViewNode.Normal)
         # displayNode.SetVisibility(True)
         displayNode.GetVolumePropertyNode().Copy(self.boneVP2)
 
         displayNode.CroppingEnabledOn()
         # displayNode.GetROINode().GetDisplayNode().SetVisibility(True)
         volRenLogic.FitROIToVolume(displayNode)
+        self.sampleNodes += [displayNode, displayNode.GetROINode(), displayNode.GetVolumePropertyNode()]
+        return displayNode
 
-        layoutManager = slicer.app.layoutManager()
-        threeDWidget = layoutManager.threeDWidget(0)
-        threeDView = threeDWidget.threeDView()
-        threeDView.resetFocalPoint()
-        threeDView.lookFromAxis(5)
+    def centerThreeDView(self):
+        # the view is looked up again only after the layout changes
+        if self.threeDView is None:
+            self.threeDView = slicer.app.layoutManager().threeDWidget(0).threeDView()
+        self.threeDView.resetFocalPoint()
+        self.threeDView.lookFromAxis(5)
+
+    def onLayoutChanged(self, layout):
+        self.threeDView = None
 
     def turnOnRender(self, volumeNode):
         volRenLogic = slicer.modules.volumerendering.logic()
@@ -881,13 +830,12 @@ class CranIALCTAnnotationWidget(ScriptedLoadableModuleWidget):
     def resetViews(self):
         # Reset ROI
         volRenLogic = slicer.modules.volumerendering.logic()
-        volRenLogic.FitROIToVolume(volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode))
-        volRenLogic.FitROIToVolume(volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume))
+        volRenLogic.FitROIToVolume(self.volumeRenderingDisplay)
+        if self.maskedVolume is not None:
+            volRenLogic.FitROIToVolume(self.maskedRenderingDisplay)
 
         # center view
-        threeDView = slicer.app.layoutManager().threeDWidget(0).threeDView()
-        threeDView.resetFocalPoint()
-        threeDView.lookFromAxis(5)
+        self.centerThreeDView()
 
         # center slice view
         slicer.util.resetSliceViews()
@@ -965,156 +913,87 @@ class CranIALCTAnnotationLogic(ScriptedLoadableModuleLogic):
         annotationLogic = slicer.modules.annotations.logic()
         annotationLogic.CreateSnapShot(name, description, type, 1, imageData)
 
+    def getOrAddSegment(self, segmentationNode, name, create=None, volumeNode=None):
+        # ID of the named segment, an empty one or one made by create is added if it is missing
+        segmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(name)
+        if segmentID == '':
+            if create is None:
+                segmentID = segmentationNode.GetSegmentation().AddEmptySegment(name)
+            else:
+                segmentID = create(segmentationNode, volumeNode)
+        return segmentID
+
+    def keepIslands(self, mask, minimumSize=0):
+        # face connected islands of the mask, either the largest one or all of at least minimumSize voxels,
+        # the same connectivity the Islands effect uses
+        import SimpleITK as sitk  # deferred, loading ITK is slow and only segmentation needs it
+        islands = sitk.RelabelComponent(sitk.ConnectedComponent(sitk.GetImageFromArray(mask.astype(np.uint8))),
+                                        minimumSize)
+        labels = sitk.GetArrayViewFromImage(islands)
+        return labels == 1 if minimumSize == 0 else labels > 0
+
     def segmentHead(self, segmentationNode, volumeNode):
-        segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        # To show segment editor widget (useful for debugging): segmentEditorWidget.show()
-        segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        segmentEditorNode = slicer.vtkMRMLSegmentEditorNode()
-        segmentEditorNode.SetOverwriteMode(2)
-        slicer.mrmlScene.AddNode(segmentEditorNode)
-        segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-        segmentEditorWidget.setSegmentationNode(segmentationNode)
-        segmentEditorWidget.setMasterVolumeNode(volumeNode)
-
-        headSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("head")
-        if headSegmentID is '':
-            headSegmentID = segmentationNode.GetSegmentation().AddEmptySegment("head")
-
-        segmentEditorNode.SetSelectedSegmentID(headSegmentID)
-        segmentEditorWidget.setActiveEffectByName("Threshold")
-
-        volumeScalarRange = volumeNode.GetImageData().GetScalarRange()
-
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("MinimumThreshold", str(-200))
-        effect.setParameter("MaximumThreshold", str(volumeScalarRange[1]))
-        effect.self().onApply()
-
-        segmentEditorWidget.setActiveEffectByName("Islands")
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameterDefault("Operation", "KEEP_LARGEST_ISLAND")
-        effect.self().onApply()
-        slicer.mrmlScene.RemoveNode(segmentEditorNode)
+        headSegmentID = self.getOrAddSegment(segmentationNode, "head")
+
+        # threshold from -200 up to the volume maximum, keep the largest island
+        headMask = self.keepIslands(slicer.util.arrayFromVolume(volumeNode) >= -200)
+        slicer.util.updateSegmentBinaryLabelmapFromArray(headMask.astype(np.uint8), segmentationNode,
+                                                         headSegmentID, volumeNode)
 
         return headSegmentID
 
+    def fillOutsideSegment(self, segmentationNode, segmentID, volumeNode, maskedVolume, fillValue=-200):
+        # Blank out voxels that are outside the segment, in one pass over the voxel array
+        mask = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentID, volumeNode)
+        voxels = slicer.util.arrayFromVolume(volumeNode)
+        slicer.util.updateVolumeFromArray(maskedVolume,
+                                          np.where(mask != 0, voxels, np.array(fillValue, dtype=voxels.dtype)))
+
     def removeTube(self, segmentationNode, volumeNode, maskedVolume):
-        # Create segment editor to get access to effects
-        segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        # To show segment editor widget (useful for debugging): segmentEditorWidget.show()
-        segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        segmentEditorNode = slicer.vtkMRMLSegmentEditorNode()
-        segmentEditorNode.SetOverwriteMode(2)
-        slicer.mrmlScene.AddNode(segmentEditorNode)
-        segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-        segmentEditorWidget.setSegmentationNode(segmentationNode)
-        segmentEditorWidget.setMasterVolumeNode(volumeNode)
-
-        headSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("head")
-
-        if headSegmentID is '':
-            headSegmentID = self.segmentHead(segmentationNode, volumeNode)
-
-        segmentEditorNode.SetSelectedSegmentID(headSegmentID)
-        segmentEditorWidget.setActiveEffectByName("Mask volume")
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("FillValue", str(-200))
-        # Blank out voxels that are outside the segment
-        effect.setParameter("Operation", "FILL_OUTSIDE")
-        effect.self().outputVolumeSelector.setCurrentNode(maskedVolume)
-        effect.self().onApply()
+        headSegmentID = self.getOrAddSegment(segmentationNode, "head", self.segmentHead, volumeNode)
+
+        self.fillOutsideSegment(segmentationNode, headSegmentID, volumeNode, maskedVolume)
 
         segmentationNode.GetDisplayNode().SetSegmentVisibility(headSegmentID, False)
-        slicer.mrmlScene.RemoveNode(segmentEditorNode)
 
     def segmentSkull(self, segmentationNode, volumeNode):
-        # Create segment editor to get access to effects
-        segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        # To show segment editor widget (useful for debugging): segmentEditorWidget.show()
-        segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        segmentEditorNode = slicer.vtkMRMLSegmentEditorNode()
-        segmentEditorNode.SetOverwriteMode(2)
-        slicer.mrmlScene.AddNode(segmentEditorNode)
-        segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-        segmentEditorWidget.setSegmentationNode(segmentationNode)
-        segmentEditorWidget.setMasterVolumeNode(volumeNode)
-
-        headSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("head")
-        if headSegmentID is '':
-            headSegmentID = self.segmentHead(segmentationNode, volumeNode)
-
-        skullSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("bone")
-
-        if skullSegmentID is '':
-            skullSegmentID = segmentationNode.GetSegmentation().AddEmptySegment("bone")
-        segmentEditorNode.SetSelectedSegmentID(skullSegmentID)
-        segmentEditorWidget.setActiveEffectByName("Threshold")
-
-        volumeScalarRange = volumeNode.GetImageData().GetScalarRange()
-
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("MinimumThreshold", str(143))
-        effect.setParameter("MaximumThreshold", str(volumeScalarRange[1]))
-        effect.self().onApply()
-
-        segmentEditorWidget.setActiveEffectByName("Islands")
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("Operation", "REMOVE_SMALL_ISLANDS")
-        effect.setParameter("MinimumSize", "1000")
-        effect.self().onApply()
-
-        segmentEditorWidget.setActiveEffectByName("Logical operators")
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("Operation", "INTERSECT")
-        effect.setParameter("ModifierSegmentID", headSegmentID)
-        effect.self().onApply()
-
-        slicer.mrmlScene.RemoveNode(segmentEditorNode)
+        headSegmentID = self.getOrAddSegment(segmentationNode, "head", self.segmentHead, volumeNode)
+        skullSegmentID = self.getOrAddSegment(segmentationNode, "bone")
+
+        # threshold from 143 up to the volume maximum, remove islands under 1000 voxels, intersect with the head
+        skullMask = self.keepIslands(slicer.util.arrayFromVolume(volumeNode) >= 143, 1000)
+        skullMask &= slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, headSegmentID, volumeNode) != 0
+        slicer.util.updateSegmentBinaryLabelmapFromArray(skullMask.astype(np.uint8), segmentationNode,
+                                                         skullSegmentID, volumeNode)
+
         return skullSegmentID
 
     def removeNoise(self, segmentationNode, volumeNode, maskedVolume):
-        # Create segment editor to get access to effects
-        segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        # To show segment editor widget (useful for debugging): segmentEditorWidget.show()
-        segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        segmentEditorNode = slicer.vtkMRMLSegmentEditorNode()
-        segmentEditorNode.SetOverwriteMode(2)
-        slicer.mrmlScene.AddNode(segmentEditorNode)
-        segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-        segmentEditorWidget.setSegmentationNode(segmentationNode)
-        segmentEditorWidget.setMasterVolumeNode(volumeNode)
-
-        skullSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("bone")
-
-        if skullSegmentID is '':
-            skullSegmentID = self.segmentSkull(segmentationNode, volumeNode)
-
-        segmentEditorNode.SetSelectedSegmentID(skullSegmentID)
-        segmentEditorWidget.setActiveEffectByName("Mask volume")
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("FillValue", str(-200))
-        # Blank out voxels that are outside the segment
-        effect.setParameter("Operation", "FILL_OUTSIDE")
-        effect.self().outputVolumeSelector.setCurrentNode(maskedVolume)
-        effect.self().onApply()
+        skullSegmentID = self.getOrAddSegment(segmentationNode, "bone", self.segmentSkull, volumeNode)
+
+        self.fillOutsideSegment(segmentationNode, skullSegmentID, volumeNode, maskedVolume)
 
         segmentationNode.GetDisplayNode().SetSegmentVisibility(skullSegmentID, False)
-        slicer.mrmlScene.RemoveNode(segmentEditorNode)
+
+    def getExportedModels(self, exportFolderItemId):
+        # model nodes exported into the subject hierarchy folder, by name
+        shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+        childIds = vtk.vtkIdList()
+        shNode.GetItemChildren(exportFolderItemId, childIds)
+        models = {}
+        for i in range(childIds.GetNumberOfIds()):
+            modelNode = shNode.GetItemDataNode(childIds.GetId(i))
+            models[modelNode.GetName()] = modelNode
+        return models
 
     def initializeSegmentation(self, segmentationNode, volumeNode):
 
         segmentation = segmentationNode.GetSegmentation()
-        headSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("head")
-        if headSegmentID is '':
-            headSegmentID = self.segmentHead(segmentationNode, volumeNode)
+        headSegmentID = self.getOrAddSegment(segmentationNode, "head", self.segmentHead, volumeNode)
 
-        skullSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("bone")
-        if skullSegmentID is '':
-            skullSegmentID = self.segmentSkull(segmentationNode, volumeNode)
+        skullSegmentID = self.getOrAddSegment(segmentationNode, "bone", self.segmentSkull, volumeNode)
 
-        intraopMaterialID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("Intraop Material")
-        if intraopMaterialID is '':
-            intraopMaterialID = segmentationNode.GetSegmentation().AddEmptySegment("Intraop Material")
+        intraopMaterialID = self.getOrAddSegment(segmentationNode, "Intraop Material")
 
         segmentationNode.CreateClosedSurfaceRepresentation()
         segmentationNode.GetDisplayNode().SetSegmentVisibility(headSegmentID, False)
@@ -1124,24 +1003,21 @@ class CranIALCTAnnotationLogic(ScriptedLoadableModuleLogic):
         return segmentationNode
 
 
-    def getActiveCell(self):
+    def getActiveSelection(self):
+        # row and text of the selected table cell, from a single selection query
         tableView = slicer.app.layoutManager().tableWidget(0).tableView()
-        if bool(tableView.selectedIndexes()):
-            index = tableView.selectedIndexes()[0]
-            indexTuple = [index.row(), index.column()]
-            tableString = tableView.mrmlTableNode().GetCellText(index.row() - 1, index.column())
-            return tableString
+        selectedIndexes = tableView.selectedIndexes()
+        if bool(selectedIndexes):
+            index = selectedIndexes[0]
+            return index.row(), tableView.mrmlTableNode().GetCellText(index.row() - 1, index.column())
         else:
-            return ""
+            return False, ""
 
-    def getActiveCellRow(self):
-        tableView = slicer.app.layoutManager().tableWidget(0).tableView()
-        if bool(tableView.selectedIndexes()):
-            index = tableView.selectedIndexes()[0]
-            return index.row()
-        else:
-            return False
+    def getActiveCell(self):
+        return self.getActiveSelection()[1]
 
+    def getActiveCellRow(self):
+        return self.getActiveSelection()[0]
 
     def hideCompletedSamples(self, table):
         rowNumber = table.GetNumberOfRows()
@@ -1149,71 +1025,53 @@ class CranIALCTAnnotationLogic(ScriptedLoadableModuleLogic):
         tableView = slicer.app.layoutManager().tableWidget(0).tableView()
         if not bool(statusColumn):
             return
-        for currentRow in range(rowNumber):
-            string = statusColumn.GetValue(currentRow)
-            if (string):  # any status should trigger hide row
-                tableView.hideRow(currentRow + 1)
-
-        table.GetTable().Modified()  # update table view
+        # read the column once, then only touch the rows that need hiding
+        values = [statusColumn.GetValue(currentRow) for currentRow in range(rowNumber)]
+        hideRows = [currentRow + 1 for currentRow, val in enumerate(values) if val]  # any status should trigger hide row
+        # hide all rows first, repaint once
+        tableView.setUpdatesEnabled(False)
+        try:
+            for row in hideRows:
+                tableView.hideRow(row)
+
+            table.GetTable().Modified()  # update table view
+        finally:
+            tableView.setUpdatesEnabled(True)
+            tableView.viewport().update()
+
+    # rotation matrices with the same convention as vtkTransform.RotateX/Y/Z, angle in radians
+    def rotationX(self, angle):
+        c, s = np.cos(angle), np.sin(angle)
+        return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+    def rotationY(self, angle):
+        c, s = np.cos(angle), np.sin(angle)
+        return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+    def rotationZ(self, angle):
+        c, s = np.cos(angle), np.sin(angle)
+        return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+    def getPorionAlignment(self, poR, poL, v):
+        # rotate about Z then Y so the porion line runs along X, then about X so v lies in the XY plane
+        po = np.subtract(poR, poL)
+        rz = self.rotationZ(-np.arctan2(po[1], po[0]))
+        po = rz @ po
+        ryz = self.rotationY(np.arctan2(po[2], po[0])) @ rz
+        v = ryz @ v
+        rotation = self.rotationX(-np.arctan2(v[2], v[1])) @ ryz
+
+        matrix = np.identity(4)
+        matrix[:3, :3] = rotation
+        return slicer.util.vtkMatrixFromArray(matrix)
 
     # Frankfort alignment
     def getFrankfortAlignment(self, poR, poL, zyoL):
-
-        po = [poR[0] - poL[0], poR[1] - poL[1], poR[2] - poL[2]]
-
-        vTransform = vtk.vtkTransform()
-        vTransform.RotateZ(-np.arctan2(po[1], po[0]) * 180 / np.pi)
-
-        po1 = vTransform.TransformPoint(poR)
-        po2 = vTransform.TransformPoint(poL)
-        zyo = vTransform.TransformPoint(zyoL)
-
-        po = [po1[0] - po2[0], po1[1] - po2[1], po1[2] - po2[2]]
-
-        vTransform2 = vtk.vtkTransform()
-        vTransform2.RotateY(np.arctan2(po[2], po[0]) * 180 / np.pi)
-
-        po1 = vTransform2.TransformPoint(po1)
-        po2 = vTransform2.TransformPoint(po2)
-        zyo = vTransform2.TransformPoint(zyo)
-
-        po_zyo = [zyo[0] - (po1[0] + po2[0]) / 2, zyo[1] - (po1[1] + po2[1]) / 2, zyo[2] - (po1[2] + po2[2]) / 2]
-
-        vTransform3 = vtk.vtkTransform()
-        vTransform3.RotateX(-np.arctan2(po_zyo[2], po_zyo[1]) * 180 / np.pi)
-
-        vTransform3.Concatenate(vTransform2)
-        vTransform3.Concatenate(vTransform)
-        return vTransform3.GetMatrix()
+        # zygoorbitale relative to the porion midpoint
+        return self.getPorionAlignment(poR, poL, np.subtract(zyoL, np.add(poR, poL) / 2))
 
     def getOSeAlignment(self, poR, poL, se, o):
-
-        po = [poR[0] - poL[0], poR[1] - poL[1], poR[2] - poL[2]]
-
-        vTransform = vtk.vtkTransform()
-        vTransform.RotateZ(-np.arctan2(po[1], po[0]) * 180 / np.pi)
-
-        po1 = vTransform.TransformPoint(poR)
-        po2 = vTransform.TransformPoint(poL)
-        se1 = vTransform.TransformPoint(se)
-        o1 = vTransform.TransformPoint(o)
-
-        po = [po1[0] - po2[0], po1[1] - po2[1], po1[2] - po2[2]]
-
-        vTransform2 = vtk.vtkTransform()
-        vTransform2.RotateY(np.arctan2(po[2], po[0]) * 180 / np.pi)
-
-        se1 = vTransform2.TransformPoint(se1)
-        o1 = vTransform2.TransformPoint(o1)
-
-        o_se = [se1[0] - o1[0], se1[1] - o1[1], se1[2] - o1[2]]
-
-        vTransform3 = vtk.vtkTransform()
-        vTransform3.RotateX(-np.arctan2(o_se[2], o_se[1]) * 180 / np.pi)
-
-        vTransform3.Concatenate(vTransform2)
-        vTransform3.Concatenate(vTransform)
-        return vTransform3.GetMatrix()
+        return self.getPorionAlignment(poR, poL, np.subtract(se, o))
 
 
 class CranIALCTAnnotationTest(ScriptedLoadableModuleTest):
@@ -1,6 +1,7 @@
 import getpass
 import logging
 import os
+import threading
 from datetime import date
 
 import ctk
@@ -15,40 +16,9 @@ from slicer.ScriptedLoadableModule import *
 #
 labs = os.environ.get('labs', 'unknown_lab')
 
-
-class MandibleNerveFlow(ScriptedLoadableModule):
-    """Uses ScriptedLoadableModule base class, available at:
-    https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
-    """
-
-    def __init__(self, parent):
-        ScriptedLoadableModule.__init__(self, parent)
-        self.parent.title = "Mandible Nerve Annotation"
-        self.parent.categories = ["SCH CranIAL"]
-        self.parent.dependencies = []
-        self.parent.contributors = [
-            "Murat Maga (UW), Sara Rolfe (UW), Ezgi Mercan (SCH)"]  # replace with "Firstname Lastname (Organization)"
-        self.parent.helpText = """
-
-"""
-        self.parent.acknowledgementText = """
-Modified by Ezgi Mercan for internal Seattle Children's Hospital Craniofacial Image Analysis Lab use. 
-The original module was developed by Sara Rolfe and Murat Maga, for the NSF HDR  grant, "Biology Guided Neural Networks" (Award Number: 1939505).
-"""
-
-    #
-
-
-# MandibleNerveFlowWidget
-#
-
-class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
-    """Uses ScriptedLoadableModuleWidget base class, available at:
-    https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
-    """
-
-    def assignLayoutDescription(self, table):
-        customLayout = """
+# 3D view and slice views on the left, project table on the right
+CUSTOM_LAYOUT_ID = 701
+CUSTOM_LAYOUT = """
     <layout type=\"horizontal\" split=\"true\" >
         <item splitSize=\"800\">
         <layout type=\"vertical\"  split=\"true\" >
@@ -90,15 +60,54 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
         </view>
         </item>
     </layout>
+"""
+
+
+class MandibleNerveFlow(ScriptedLoadableModule):
+    """Uses ScriptedLoadableModule base class, available at:
+    https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
-        customLayoutId = 701
+    def __init__(self, parent):
+        ScriptedLoadableModule.__init__(self, parent)
+        self.parent.title = "Mandible Nerve Annotation"
+        self.parent.categories = ["SCH CranIAL"]
+        self.parent.dependencies = []
+        self.parent.contributors = [
+            "Murat Maga (UW), Sara Rolfe (UW), Ezgi Mercan (SCH)"]  # replace with "Firstname Lastname (Organization)"
+        self.parent.helpText = """
+
+"""
+        self.parent.acknowledgementText = """
+Modified by Ezgi Mercan for internal Seattle Children's Hospital Craniofacial Image Analysis Lab use. 
+The original module was developed by Sara Rolfe and Murat Maga, for the NSF HDR  grant, "Biology Guided Neural Networks" (Award Number: 1939505).
+"""
 
+    #
+
+
+# MandibleNerveFlowWidget
+#
+
+class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
+    """Uses ScriptedLoadableModuleWidget base class, available at:
+    https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+    """
+
+    def assignLayoutDescription(self, table):
         layoutManager = slicer.app.layoutManager()
-        layoutManager.layoutLogic().GetLayoutNode().AddLayoutDescription(customLayoutId, customLayout)
+        layoutNode = layoutManager.layoutLogic().GetLayoutNode()
+        if not layoutNode.IsLayoutDescription(CUSTOM_LAYOUT_ID):
+            layoutNode.AddLayoutDescription(CUSTOM_LAYOUT_ID, CUSTOM_LAYOUT)
 
         # Switch to the new custom layout
-        layoutManager.setLayout(customLayoutId)
+        layoutManager.setLayout(CUSTOM_LAYOUT_ID)
+
+        # Reslice on a single thread, threaded reslicing contends with threaded GL drivers and slows slice browsing
+        for sliceViewName in ("Red", "Green", "Yellow"):
+            sliceLogic = layoutManager.sliceWidget(sliceViewName).sliceLogic()
+            for layerLogic in (sliceLogic.GetBackgroundLayer(), sliceLogic.GetForegroundLayer()):
+                layerLogic.GetReslice().SetNumberOfThreads(1)
 
         # Select table in viewer
         slicer.app.applicationLogic().GetSelectionNode().SetReferenceActiveTableID(table.GetID())
@@ -107,6 +116,8 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
+        self.logic = MandibleNerveFlowLogic()
+
         # For cleaning tube/noise
         self.headSegmentID = None
         self.skullSegmentId = None
@@ -115,14 +126,11 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
         self.segmentEditorNode = None
         self.planeNode = None
 
-        # 3D render presets
-        self.softTissueVP = slicer.util.loadNodeFromFile(self.resourcePath("CT-SoftTissue.vp"),
-                                                         "TransferFunctionFile")
-        self.boneVP = slicer.util.loadNodeFromFile(self.resourcePath("CT-Bone.vp"),
-                                                   "TransferFunctionFile")
-
-        self.boneVP2 = slicer.util.loadNodeFromFile(self.resourcePath("CT-Bone2.vp"),
-                                                    "TransferFunctionFile")
+        # 3D render presets, loaded once the panel is shown
+        self.softTissueVP = None
+        self.boneVP = None
+        self.boneVP2 = None
+        qt.QTimer.singleShot(0, self.ensureVolumeProperties)
 
         # region IO
 
@@ -355,9 +363,14 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
         if len(paths) >= 4:
             self.tablepath = paths[0]
             self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
+            self.tableMtime = os.path.getmtime(self.tablepath)
 
             with open(paths[1], "r") as file:
-                self.landmarkNames = np.array(file.read().splitlines())
+                self.landmarkNames = file.read().splitlines()
+            # first index of every landmark name, for constant time lookups
+            self.landmarkIdx = {}
+            for i, name in enumerate(self.landmarkNames):
+                self.landmarkIdx.setdefault(name, i)
 
             self.imagedir = paths[2]
             self.landmarkdir = paths[3]
@@ -378,14 +391,27 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
             self.importVolumeButton.enabled = False
 
     def onImportVolume(self):
-        logic = MandibleNerveFlowLogic()
-        self.activeCellString = logic.getActiveCell()
+        self.activeCellString = self.logic.getActiveCell()
 
         if bool(self.activeCellString):
             volumePath = os.path.join(self.imagedir, self.activeCellString)
-            self.volumeNode = logic.runImport(volumePath)
+            # the selected image is still open, decoding it again would only duplicate the sample
+            if getattr(self, 'volumePath', None) == volumePath and hasattr(self, 'volumeNode') and \
+                    slicer.mrmlScene.IsNodePresent(self.volumeNode):
+                msg = qt.QMessageBox()
+                msg.setIcon(qt.QMessageBox.Information)
+                msg.setText(
+                    "Image \"" + self.activeCellString + "\" is already open.")
+                msg.setWindowTitle("Image already loaded")
+                msg.setStandardButtons(qt.QMessageBox.Ok)
+                msg.exec_()
+                logging.debug("%s is already loaded." % volumePath)
+                return
+
+            self.volumeNode = self.logic.runImport(volumePath)
             if bool(self.volumeNode):
-                self.activeRow = logic.getActiveCellRow()
+                self.volumePath = volumePath
+                self.activeRow = self.logic.getActiveCellRow()
                 # self.updateStatus(self.activeRow, 'Processing')
 
                 # Set window/level of the volume to bone
@@ -397,26 +423,25 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
                 # center slice view
                 slicer.util.resetSliceViews()
 
-                # 3D render
-                self.maskedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
-                                                                       "Temporary masked volume")
-                self.maskedVolume.CopyContent(self.volumeNode)
-                self.render3d(self.maskedVolume)
-                self.turnOffRender(self.maskedVolume)
+                # 3D render, the masked copy is made once the volume is first masked
+                self.maskedVolume = None
 
                 self.render3d(self.volumeNode)
                 self.turnOffRender(self.volumeNode)
+                self.centerThreeDView()
 
                 # fiducials
 
                 fileName = os.path.splitext(self.activeCellString)[0]
                 fileName = os.path.splitext(fileName)[0]
                 self.volumeNode.SetName(fileName)
+                # landmark, segmentation and plane files of the sample share this prefix
+                self.samplePathPrefix = os.path.join(self.landmarkdir, fileName)
 
                 try:
                     print("Loading fiducial")
                     success, self.fiducialNode = slicer.util.loadMarkupsFiducialList(
-                        os.path.join(self.landmarkdir, fileName + '.fcsv'))
+                        self.samplePathPrefix + '.fcsv')
 
                     if success:
                         self.fiducialNode.SetName(fileName)
@@ -432,16 +457,16 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
                 try:
                     print("Loading segmentation")
                     self.segmentationNode = slicer.util.loadSegmentation(
-                        os.path.join(self.landmarkdir, fileName + '.seg.nrrd'))
+                        self.samplePathPrefix + '.seg.nrrd')
                     self.segmentationNode.SetName(fileName)
                 except:
                     print("failed loading segmentation")
 
                 # Plane
                 try:
-                    print("Loading plane " + os.path.join(self.landmarkdir, fileName + '.occ.plane.mrk.json'))
+                    print("Loading plane " + self.samplePathPrefix + '.occ.plane.mrk.json')
                     self.planeNode = slicer.util.loadMarkups(
-                        os.path.join(self.landmarkdir, fileName + '.occ.plane.mrk.json'))
+                        self.samplePathPrefix + '.occ.plane.mrk.json')
                     self.planeNode.SetName(fileName + ".occ.plane")
                 except:
                     print("failed loading plane")
@@ -455,7 +480,6 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
                 self.transformNode.SetAndObserveTransformToParent(transform)
 
                 self.volumeNode.SetAndObserveTransformNodeID(self.transformNode.GetID())
-                self.maskedVolume.SetAndObserveTransformNodeID(self.transformNode.GetID())
                 self.fiducialNode.SetAndObserveTransformNodeID(self.transformNode.GetID())
 
                 if self.segmentationNode is not None:
@@ -465,11 +489,16 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
 
                 self.enableButtons()
 
+                # the next sample is usually opened next, read its file while this one is annotated
+                nextCellString = self.logic.getNextCell()
+                if bool(nextCellString):
+                    self.logic.prefetchFile(os.path.join(self.imagedir, nextCellString))
+
             else:
                 msg = qt.QMessageBox()
                 msg.setIcon(qt.QMessageBox.Warning)
                 msg.setText(
-                    "Image \"" + logic.getActiveCell() + "\" is not in folder \"" + self.imagedir + ".")
+                    "Image \"" + self.logic.getActiveCell() + "\" is not in folder \"" + self.imagedir + ".")
                 msg.setWindowTitle("Image cannot be loaded")
                 msg.setStandardButtons(qt.QMessageBox.Ok)
                 msg.exec_()
@@ -492,23 +521,54 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
         displayNode.SetWindow(100)
         displayNode.SetLevel(50)
 
+    def ensureVolumeProperties(self):
+        # Load the render presets on first use instead of while the module panel is built
+        if self.boneVP is None:
+            self.softTissueVP = slicer.util.loadNodeFromFile(self.resourcePath("CT-SoftTissue.vp"),
+                                                             "TransferFunctionFile")
+            self.boneVP = slicer.util.loadNodeFromFile(self.resourcePath("CT-Bone.vp"),
+                                                       "TransferFunctionFile")
+            self.boneVP2 = slicer.util.loadNodeFromFile(self.resourcePath("CT-Bone2.vp"),
+                                                        "TransferFunctionFile")
+
     def onBoneRender(self):
+        self.ensureVolumeProperties()
         volRenLogic = slicer.modules.volumerendering.logic()
         volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode).GetVolumePropertyNode().Copy(self.boneVP)
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(self.boneVP)
+        if self.maskedVolume is not None:
+            volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(self.boneVP)
 
     def onBoneRender2(self):
+        self.ensureVolumeProperties()
         volRenLogic = slicer.modules.volumerendering.logic()
         volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode).GetVolumePropertyNode().Copy(self.boneVP2)
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(self.boneVP2)
+        if self.maskedVolume is not None:
+            volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(
+                self.boneVP2)
 
     def onSoftTissueRender(self):
         # Set window/level of the volume to bone
+        self.ensureVolumeProperties()
         volRenLogic = slicer.modules.volumerendering.logic()
         volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode).GetVolumePropertyNode().Copy(
             self.softTissueVP)
-        volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(
-            self.softTissueVP)
+        if self.maskedVolume is not None:
+            volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(
+                self.softTissueVP)
+
+    def ensureMaskedVolume(self):
+        if self.maskedVolume is None:
+            self.maskedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
+                                                                   "Temporary masked volume")
+            self.maskedVolume.CopyContent(self.volumeNode)
+            self.render3d(self.maskedVolume)
+            self.turnOffRender(self.maskedVolume)
+            # start from the render preset shown for the original volume
+            volRenLogic = slicer.modules.volumerendering.logic()
+            volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume).GetVolumePropertyNode().Copy(
+                volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode).GetVolumePropertyNode())
+            self.maskedVolume.SetAndObserveTransformNodeID(self.transformNode.GetID())
+        return self.maskedVolume
 
     def removeTube(self):
         if self.headSegmentID is None:
@@ -518,73 +578,32 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
             self.cleaningSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(self.volumeNode)
             self.cleaningSegmentation.SetAndObserveTransformNodeID(self.transformNode.GetID())
 
-            self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-            # To show segment editor widget (useful for debugging): segmentEditorWidget.show()
-            self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-            self.segmentEditorNode = slicer.vtkMRMLSegmentEditorNode()
-            self.segmentEditorNode.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteNone)
-            slicer.mrmlScene.AddNode(self.segmentEditorNode)
-            self.segmentEditorWidget.setMRMLSegmentEditorNode(self.segmentEditorNode)
-            self.segmentEditorWidget.setSegmentationNode(self.cleaningSegmentation)
-            self.segmentEditorWidget.setMasterVolumeNode(self.volumeNode)
-
             self.headSegmentID = self.cleaningSegmentation.GetSegmentation().AddEmptySegment("head")
-            self.segmentEditorNode.SetSelectedSegmentID(self.headSegmentID)
-            self.segmentEditorWidget.setActiveEffectByName("Threshold")
-
-            volumeScalarRange = self.volumeNode.GetImageData().GetScalarRange()
-
-            effect = self.segmentEditorWidget.activeEffect()
-            effect.setParameter("MinimumThreshold", str(-200))
-            effect.setParameter("MaximumThreshold", str(volumeScalarRange[1]))
-            effect.self().onApply()
 
-            self.segmentEditorWidget.setActiveEffectByName("Islands")
-            effect = self.segmentEditorWidget.activeEffect()
-            effect.setParameterDefault("Operation", "KEEP_LARGEST_ISLAND")
-            effect.self().onApply()
+            # threshold from -200 up to the volume maximum, keep the largest island
+            headMask = self.logic.keepIslands(slicer.util.arrayFromVolume(self.volumeNode) >= -200)
+            slicer.util.updateSegmentBinaryLabelmapFromArray(headMask.astype(np.uint8), self.cleaningSegmentation,
+                                                             self.headSegmentID, self.volumeNode)
 
     def removeNoise(self):
         if self.headSegmentID is None:
             self.removeTube()
         if self.skullSegmentId is None:
             self.skullSegmentId = self.cleaningSegmentation.GetSegmentation().AddEmptySegment("bone")
-            self.segmentEditorNode.SetSelectedSegmentID(self.skullSegmentId)
-            self.segmentEditorWidget.setActiveEffectByName("Threshold")
 
-            volumeScalarRange = self.volumeNode.GetImageData().GetScalarRange()
-
-            effect = self.segmentEditorWidget.activeEffect()
-            effect.setParameter("MinimumThreshold", str(143))
-            effect.setParameter("MaximumThreshold", str(volumeScalarRange[1]))
-            effect.self().onApply()
-
-            self.segmentEditorWidget.setActiveEffectByName("Islands")
-            effect = self.segmentEditorWidget.activeEffect()
-            effect.setParameter("Operation", "REMOVE_SMALL_ISLANDS")
-            effect.setParameter("MinimumSize", "1000")
-            effect.self().onApply()
-
-            self.segmentEditorWidget.setActiveEffectByName("Logical operators")
-            effect = self.segmentEditorWidget.activeEffect()
-            effect.setParameter("Operation", "INTERSECT")
-            effect.setParameter("ModifierSegmentID", self.headSegmentID)
-            effect.self().onApply()
+            # threshold from 143 up to the volume maximum, remove islands under 1000 voxels, intersect with the head
+            skullMask = self.logic.keepIslands(slicer.util.arrayFromVolume(self.volumeNode) >= 143, 1000)
+            skullMask &= slicer.util.arrayFromSegmentBinaryLabelmap(self.cleaningSegmentation, self.headSegmentID,
+                                                                    self.volumeNode) != 0
+            slicer.util.updateSegmentBinaryLabelmapFromArray(skullMask.astype(np.uint8), self.cleaningSegmentation,
+                                                             self.skullSegmentId, self.volumeNode)
 
     def onRemoveTube(self):
 
         self.removeTube()
 
-        self.segmentEditorNode.SetSelectedSegmentID(self.headSegmentID)
-        self.segmentEditorWidget.setActiveEffectByName("Mask volume")
-        effect = self.segmentEditorWidget.activeEffect()
-        effect.setParameter("FillValue", str(-200))
-        # Blank out voxels that are outside the segment
-        effect.setParameter("Operation", "FILL_OUTSIDE")
-        # Create a volume that will store temporary masked volumes
-
-        effect.self().outputVolumeSelector.setCurrentNode(self.maskedVolume)
-        effect.self().onApply()
+        self.logic.fillOutsideSegment(self.cleaningSegmentation, self.headSegmentID, self.volumeNode,
+                                      self.ensureMaskedVolume())
 
         self.turnOffRender(self.volumeNode)
         self.turnOnRender(self.maskedVolume)
@@ -592,38 +611,44 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
     def onRemoveNoise(self):
         self.removeNoise()
 
-        self.segmentEditorNode.SetSelectedSegmentID(self.skullSegmentId)
-        self.segmentEditorWidget.setActiveEffectByName("Mask volume")
-        effect = self.segmentEditorWidget.activeEffect()
-        effect.setParameter("FillValue", str(-200))
-        # Blank out voxels that are outside the segment
-        effect.setParameter("Operation", "FILL_OUTSIDE")
-        # Create a volume that will store temporary masked volumes
-
-        effect.self().outputVolumeSelector.setCurrentNode(self.maskedVolume)
-        effect.self().onApply()
+        self.logic.fillOutsideSegment(self.cleaningSegmentation, self.skullSegmentId, self.volumeNode,
+                                      self.ensureMaskedVolume())
 
         self.turnOffRender(self.volumeNode)
         self.turnOnRender(self.maskedVolume)
 
     def onOriginalVolume(self):
-        self.turnOffRender(self.maskedVolume)
+        if self.maskedVolume is not None:
+            self.turnOffRender(self.maskedVolume)
         self.turnOnRender(self.volumeNode)
 
-    def onFrankfort(self):
+    def getLandmarkIds(self, names):
+        # indices of the named landmarks in the landmark list
+        return tuple(self.landmarkIdx[name] for name in names)
 
-        for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
-            self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
+    def getLandmarkPositions(self, ids):
+        # positions of the given control points, fetched from the markups node in one call
+        return slicer.util.arrayFromMarkupsControlPoints(self.fiducialNode)[list(ids)].tolist()
 
-        logic = MandibleNerveFlowLogic()
+    def nameFiducials(self):
+        # relabel under a single modified event, only points whose label differs are touched
+        with slicer.util.NodeModify(self.fiducialNode):
+            for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
+                if self.fiducialNode.GetNthControlPointLabel(i) != self.landmarkNames[i]:
+                    self.fiducialNode.SetNthControlPointLabel(i, self.landmarkNames[i])
 
-        zyoL_id = np.where(self.landmarkNames == "zyoL")[0][0]
-        poR_id = np.where(self.landmarkNames == "poR")[0][0]
-        poL_id = np.where(self.landmarkNames == "poL")[0][0]
+    def runAlignment(self, names, getAlignment):
+        # align the scene with the matrix computed from the named landmarks, passed in the given order
+        self.nameFiducials()
 
-        if (self.fiducialNode.GetNumberOfFiducials() <= zyoL_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poL_id):
+        try:
+            ids = self.getLandmarkIds(names)
+            missing = max(ids) >= self.fiducialNode.GetNumberOfFiducials()
+        except KeyError:
+            # the landmark name file does not list one of the landmarks
+            missing = True
+
+        if missing:
             msg = qt.QMessageBox()
             msg.setIcon(qt.QMessageBox.Warning)
             msg.setText("All necessary landmarks not marked yet")
@@ -633,139 +658,27 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
             logging.debug("Error loading associated files.")
             return
 
-        poR = [0, 0, 0]
-        poL = [0, 0, 0]
-        zyoL = [0, 0, 0]
-
-        self.fiducialNode.GetNthFiducialPosition(poR_id, poR)
-        self.fiducialNode.GetNthFiducialPosition(poL_id, poL)
-        self.fiducialNode.GetNthFiducialPosition(zyoL_id, zyoL)
-        mat = logic.getFrankfortAlignment(poR, poL, zyoL)
+        mat = getAlignment(*self.getLandmarkPositions(ids))
 
-        self.transformNode.SetAndObserveMatrixTransformToParent(mat)
+        self.transformNode.SetMatrixTransformToParent(mat)
 
         self.resetViews()
 
-        print("Frankfort Alignment")
+    def onFrankfort(self):
+        self.runAlignment(("poR", "poL", "zyoL"), self.logic.getFrankfortAlignment)
+        logging.debug("Frankfort Alignment")
 
     def onFrankfort2(self):
-
-        for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
-            self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
-
-        logic = MandibleNerveFlowLogic()
-
-        zyoR_id = np.where(self.landmarkNames == "zyoR")[0][0]
-        poR_id = np.where(self.landmarkNames == "poR")[0][0]
-        poL_id = np.where(self.landmarkNames == "poL")[0][0]
-
-        if (self.fiducialNode.GetNumberOfFiducials() <= zyoR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poL_id):
-            msg = qt.QMessageBox()
-            msg.setIcon(qt.QMessageBox.Warning)
-            msg.setText("All necessary landmarks not marked yet")
-            msg.setWindowTitle("Missing landmark")
-            msg.setStandardButtons(qt.QMessageBox.Ok)
-            msg.exec_()
-            logging.debug("Error loading associated files.")
-            return
-
-        poR = [0, 0, 0]
-        poL = [0, 0, 0]
-        zyoR = [0, 0, 0]
-
-        self.fiducialNode.GetNthFiducialPosition(poR_id, poR)
-        self.fiducialNode.GetNthFiducialPosition(poL_id, poL)
-        self.fiducialNode.GetNthFiducialPosition(zyoR_id, zyoR)
-        mat = logic.getFrankfortAlignment(poR, poL, zyoR)
-
-        self.transformNode.SetAndObserveMatrixTransformToParent(mat)
-
-        self.resetViews()
-
-        print("Frankfort Alignment right")
+        self.runAlignment(("poR", "poL", "zyoR"), self.logic.getFrankfortAlignment)
+        logging.debug("Frankfort Alignment right")
 
     def onOSeaAlignment(self):
-
-        for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
-            self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
-
-        logic = MandibleNerveFlowLogic()
-
-        o_id = np.where(self.landmarkNames == "o")[0][0]
-        se_id = np.where(self.landmarkNames == "se")[0][0]
-        poR_id = np.where(self.landmarkNames == "poR")[0][0]
-        poL_id = np.where(self.landmarkNames == "poL")[0][0]
-
-        if (self.fiducialNode.GetNumberOfFiducials() <= se_id) | (self.fiducialNode.GetNumberOfFiducials() <= o_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poL_id):
-            msg = qt.QMessageBox()
-            msg.setIcon(qt.QMessageBox.Warning)
-            msg.setText("All necessary landmarks not marked yet")
-            msg.setWindowTitle("Missing landmark")
-            msg.setStandardButtons(qt.QMessageBox.Ok)
-            msg.exec_()
-            logging.debug("Error loading associated files.")
-            return
-
-        poR = [0, 0, 0]
-        poL = [0, 0, 0]
-        se = [0, 0, 0]
-        o = [0, 0, 0]
-
-        self.fiducialNode.GetNthFiducialPosition(poR_id, poR)
-        self.fiducialNode.GetNthFiducialPosition(poL_id, poL)
-        self.fiducialNode.GetNthFiducialPosition(se_id, se)
-        self.fiducialNode.GetNthFiducialPosition(o_id, o)
-        mat = logic.getOSeAlignment(poR, poL, se, o)
-
-        self.transformNode.SetAndObserveMatrixTransformToParent(mat)
-
-        self.resetViews()
-
-        print("O-Se Alignment")
+        self.runAlignment(("poR", "poL", "se", "o"), self.logic.getOSeAlignment)
+        logging.debug("O-Se Alignment")
 
     def onONaAlignment(self):
-        for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
-            self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
-
-        logic = MandibleNerveFlowLogic()
-
-        o_id = np.where(self.landmarkNames == "o")[0][0]
-        na_id = np.where(self.landmarkNames == "n")[0][0]
-        poR_id = np.where(self.landmarkNames == "poR")[0][0]
-        poL_id = np.where(self.landmarkNames == "poL")[0][0]
-
-        if (self.fiducialNode.GetNumberOfFiducials() <= na_id) | (self.fiducialNode.GetNumberOfFiducials() <= o_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poR_id) | (
-                self.fiducialNode.GetNumberOfFiducials() <= poL_id):
-            msg = qt.QMessageBox()
-            msg.setIcon(qt.QMessageBox.Warning)
-            msg.setText("All necessary landmarks not marked yet")
-            msg.setWindowTitle("Missing landmark")
-            msg.setStandardButtons(qt.QMessageBox.Ok)
-            msg.exec_()
-            logging.debug("Error loading associated files.")
-            return
-
-        poR = [0, 0, 0]
-        poL = [0, 0, 0]
-        na = [0, 0, 0]
-        o = [0, 0, 0]
-
-        self.fiducialNode.GetNthFiducialPosition(poR_id, poR)
-        self.fiducialNode.GetNthFiducialPosition(poL_id, poL)
-        self.fiducialNode.GetNthFiducialPosition(na_id, na)
-        self.fiducialNode.GetNthFiducialPosition(o_id, o)
-        mat = logic.getOSeAlignment(poR, poL, na, o)
-
-        self.transformNode.SetAndObserveMatrixTransformToParent(mat)
-
-        self.resetViews()
-
-        print("O-Na Alignment")
+        self.runAlignment(("poR", "poL", "n", "o"), self.logic.getOSeAlignment)
+        logging.debug("O-Na Alignment")
 
     def onMarkIncomplete(self):
         # TODO ask for a reason, maybe a text box?
@@ -777,11 +690,14 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
 
     def onExportLandmarks(self):
         if hasattr(self, 'fiducialNode'):
-            for i in range(0, self.fiducialNode.GetNumberOfControlPoints()):
-                self.fiducialNode.SetNthFiducialLabel(i, self.landmarkNames[i])
-
-            if slicer.util.saveNode(self.fiducialNode,
-                                    os.path.join(self.landmarkdir, self.fiducialNode.GetName() + ".fcsv")):
+            self.nameFiducials()
+
+            fiducialPath = self.samplePathPrefix + '.fcsv'
+            # the file already holds these landmarks when the node is unchanged since it was read or saved there
+            storageNode = self.fiducialNode.GetStorageNode()
+            unchanged = storageNode is not None and storageNode.GetFileName() == fiducialPath and \
+                not self.fiducialNode.GetModifiedSinceRead()
+            if unchanged or slicer.util.saveNode(self.fiducialNode, fiducialPath):
                 self.updateTableAndGUI("Landmarks")
             else:
                 msg = qt.QMessageBox()
@@ -793,20 +709,24 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
                 # msg.buttonClicked.connect(msgbtn)
                 msg.exec_()
 
-    def onStartSegmentation(self):
+    def ensureSegmentEditor(self):
+        # Hidden segment editor, created once and reused for every sample
         if self.segmentEditorNode is None:
             self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
+            # To show segment editor widget (useful for debugging): segmentEditorWidget.show()
             self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
             self.segmentEditorNode = slicer.vtkMRMLSegmentEditorNode()
             self.segmentEditorNode.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteNone)
             slicer.mrmlScene.AddNode(self.segmentEditorNode)
 
+    def onStartSegmentation(self):
+        self.ensureSegmentEditor()
+
         if self.segmentationNode is None:
-            logic = MandibleNerveFlowLogic()
-            self.segmentationNode = logic.initializeSegmentation(self.volumeNode)
+            self.segmentationNode = self.logic.initializeSegmentation(self.volumeNode)
             self.segmentationNode.SetAndObserveTransformNodeID(self.transformNode.GetID())
             self.exportSegmentationButton.enabled = True
-            logic.segmentSkull(self.segmentationNode, self.segmentEditorNode, self.segmentEditorWidget, self.volumeNode)
+            self.logic.segmentSkull(self.segmentationNode, self.segmentEditorNode, self.segmentEditorWidget, self.volumeNode)
             self.startSegmentationButton.enabled = False
             self.turnOffRender(self.volumeNode)
 
@@ -817,17 +737,18 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
             shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
             exportFolderItemId = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Segments")
             slicer.modules.segmentations.logic().ExportAllSegmentsToModels(self.segmentationNode, exportFolderItemId)
+            models = self.logic.getExportedModels(exportFolderItemId)
 
             if slicer.util.saveNode(self.segmentationNode,
                                     os.path.join(self.landmarkdir, self.segmentationNode.GetName() + ".seg.nrrd")) and \
-                    slicer.util.saveNode(slicer.util.getNode("Mandible"), os.path.join(self.landmarkdir,
-                                                                                       self.segmentationNode.GetName() + ".mandible.ply")) and \
-                    slicer.util.saveNode(slicer.util.getNode("Mandible.filled"), os.path.join(self.landmarkdir,
-                                                                                              self.segmentationNode.GetName() + ".mandible.filled.ply")) and \
-                    slicer.util.saveNode(slicer.util.getNode("inf.alv.nerve.right"), os.path.join(self.landmarkdir,
-                                                                                                  self.segmentationNode.GetName() + ".inf.alv.nerve.right.ply")) and \
-                    slicer.util.saveNode(slicer.util.getNode("inf.alv.nerve.left"), os.path.join(self.landmarkdir,
-                                                                                                 self.segmentationNode.GetName() + ".inf.alv.nerve.left.ply")):
+                    slicer.util.saveNode(models["Mandible"], os.path.join(self.landmarkdir,
+                                                                          self.segmentationNode.GetName() + ".mandible.ply")) and \
+                    slicer.util.saveNode(models["Mandible.filled"], os.path.join(self.landmarkdir,
+                                                                                 self.segmentationNode.GetName() + ".mandible.filled.ply")) and \
+                    slicer.util.saveNode(models["inf.alv.nerve.right"], os.path.join(self.landmarkdir,
+                                                                                     self.segmentationNode.GetName() + ".inf.alv.nerve.right.ply")) and \
+                    slicer.util.saveNode(models["inf.alv.nerve.left"], os.path.join(self.landmarkdir,
+                                                                                    self.segmentationNode.GetName() + ".inf.alv.nerve.left.ply")):
 
                 self.updateTableAndGUI("Segmentation")
 
@@ -872,13 +793,19 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
         # self.startSegmentationButton.enabled = False
         # self.exportSegmentationButton.enabled = False
 
+    def reloadTableIfChanged(self):
+        # re-read the table only when the file was written since it was loaded or saved here
+        if os.path.getmtime(self.tablepath) > self.tableMtime:
+            name = self.fileTable.GetName()
+            slicer.mrmlScene.RemoveNode(self.fileTable)
+            self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
+            self.fileTable.SetLocked(True)
+            self.fileTable.SetName(name)
+            self.tableMtime = os.path.getmtime(self.tablepath)
+
     def updateStatus(self, index, statusColumName, status_string):
-        # refresh table from file, update the status column, and save
-        name = self.fileTable.GetName()
-        slicer.mrmlScene.RemoveNode(self.fileTable)
-        self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
-        self.fileTable.SetLocked(True)
-        self.fileTable.SetName(name)
+        # update the status column of the loaded table in place, and save
+        self.reloadTableIfChanged()
         # logic = MandibleNerveFlowLogic()
         # logic.hideCompletedSamples(self.fileTable)
         statusColumn = self.fileTable.GetTable().GetColumnByName(statusColumName)
@@ -887,59 +814,62 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
 
         self.fileTable.GetTable().Modified()  # update table view
         slicer.util.saveNode(self.fileTable, self.tablepath)
+        self.tableMtime = os.path.getmtime(self.tablepath)
 
     def checkAndCleanup(self, index):
-        name = self.fileTable.GetName()
-        slicer.mrmlScene.RemoveNode(self.fileTable)
-        self.fileTable = slicer.util.loadNodeFromFile(self.tablepath, 'TableFile')
-        self.fileTable.SetLocked(True)
-        self.fileTable.SetName(name)
-
-        if (self.fileTable.GetTable().GetColumnByName("Segmentation").GetValue(index - 1) is not "") and (
-                self.fileTable.GetTable().GetColumnByName("Plane").GetValue(index - 1) is not "") and (
-                self.fileTable.GetTable().GetColumnByName("Landmarks").GetValue(index - 1) is not ""):
+        self.reloadTableIfChanged()
+
+        if (self.fileTable.GetTable().GetColumnByName("Segmentation").GetValue(index - 1) != "") and (
+                self.fileTable.GetTable().GetColumnByName("Plane").GetValue(index - 1) != "") and (
+                self.fileTable.GetTable().GetColumnByName("Landmarks").GetValue(index - 1) != ""):
             self.cleanup()
 
     def cleanup(self):
 
-        if hasattr(self, 'fiducialNode'):
-            slicer.mrmlScene.RemoveNode(self.fiducialNode)
-        if hasattr(self, 'volumeNode'):
-            slicer.mrmlScene.RemoveNode(self.volumeNode)
-        if hasattr(self, 'maskedVolume'):
-            slicer.mrmlScene.RemoveNode(self.maskedVolume)
-        if hasattr(self, 'segmentationNode'):
-            slicer.mrmlScene.RemoveNode(self.segmentationNode)
-        if hasattr(self, 'labelMap'):
-            slicer.mrmlScene.RemoveNode(self.labelMap)
-        if hasattr(self, 'transformNode'):
-            slicer.mrmlScene.RemoveNode(self.transformNode)
-        if hasattr(self, 'cleaningSegmentation'):
-            slicer.mrmlScene.RemoveNode(self.cleaningSegmentation)
-        # if hasattr(self, 'segmentEditorNode'):
-        #     slicer.mrmlScene.RemoveNode(self.segmentEditorNode)
-        if hasattr(self, 'planeNode'):
-            slicer.mrmlScene.RemoveNode(self.planeNode)
+        # nodes are removed in one batch, observers are notified once at the end
+        slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+        try:
+            if hasattr(self, 'fiducialNode'):
+                slicer.mrmlScene.RemoveNode(self.fiducialNode)
+            if hasattr(self, 'volumeNode'):
+                slicer.mrmlScene.RemoveNode(self.volumeNode)
+            if hasattr(self, 'maskedVolume') and self.maskedVolume is not None:
+                slicer.mrmlScene.RemoveNode(self.maskedVolume)
+            if hasattr(self, 'segmentationNode'):
+                slicer.mrmlScene.RemoveNode(self.segmentationNode)
+            if hasattr(self, 'labelMap'):
+                slicer.mrmlScene.RemoveNode(self.labelMap)
+            if hasattr(self, 'transformNode'):
+                slicer.mrmlScene.RemoveNode(self.transformNode)
+            if hasattr(self, 'cleaningSegmentation'):
+                slicer.mrmlScene.RemoveNode(self.cleaningSegmentation)
+            # if hasattr(self, 'segmentEditorNode'):
+            #     slicer.mrmlScene.RemoveNode(self.segmentEditorNode)
+            if hasattr(self, 'planeNode'):
+                slicer.mrmlScene.RemoveNode(self.planeNode)
+
+            annotationROIs = slicer.mrmlScene.GetNodesByClass("vtkMRMLAnnotationROINode")
+            for roi in annotationROIs:
+                slicer.mrmlScene.RemoveNode(roi)
+
+            shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+            shNode.RemoveItem(shNode.GetItemByName("Segments"))
+            segments = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
+            for segment in segments:
+                slicer.mrmlScene.RemoveNode(segment)
+
+            vps = slicer.mrmlScene.GetNodesByClass("vtkMRMLVolumePropertyNode")
+            for vp in vps:
+                slicer.mrmlScene.RemoveNode(vp)
+        finally:
+            slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
 
         self.headSegmentID = None
         self.skullSegmentId = None
         self.segmentationNode = None
+        self.maskedVolume = None
         self.planeNode = None
 
-        annotationROIs = slicer.mrmlScene.GetNodesByClass("vtkMRMLAnnotationROINode")
-        for roi in annotationROIs:
-            slicer.mrmlScene.RemoveNode(roi)
-
-        shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-        shNode.RemoveItem(shNode.GetItemByName("Segments"))
-        segments = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
-        for segment in segments:
-            slicer.mrmlScene.RemoveNode(segment)
-
-        vps = slicer.mrmlScene.GetNodesByClass("vtkMRMLVolumePropertyNode")
-        for vp in vps:
-            slicer.mrmlScene.RemoveNode(vp)
-
         self.disableButtons()
 
     def enableButtons(self):
@@ -994,6 +924,7 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
 
     def render3d(self, volumeNode):
         # 3D render volume
+        self.ensureVolumeProperties()
         volRenLogic = slicer.modules.volumerendering.logic()
         displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(volumeNode)
         # displayNode.SetVisibility(True)
@@ -1003,6 +934,7 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
         # displayNode.GetROINode().GetDisplayNode().SetVisibility(True)
         volRenLogic.FitROIToVolume(displayNode)
 
+    def centerThreeDView(self):
         layoutManager = slicer.app.layoutManager()
         threeDWidget = layoutManager.threeDWidget(0)
         threeDView = threeDWidget.threeDView()
@@ -1025,7 +957,8 @@ class MandibleNerveFlowWidget(ScriptedLoadableModuleWidget):
         # Reset ROI
         volRenLogic = slicer.modules.volumerendering.logic()
         volRenLogic.FitROIToVolume(volRenLogic.GetFirstVolumeRenderingDisplayNode(self.volumeNode))
-        volRenLogic.FitROIToVolume(volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume))
+        if self.maskedVolume is not None:
+            volRenLogic.FitROIToVolume(volRenLogic.GetFirstVolumeRenderingDisplayNode(self.maskedVolume))
 
         # center view
         threeDView = slicer.app.layoutManager().threeDWidget(0).threeDView()
@@ -1066,6 +999,11 @@ class MandibleNerveFlowLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    def __init__(self):
+        ScriptedLoadableModuleLogic.__init__(self)
+        self.prefetchPath = None
+        self.prefetchThread = None
+
     def run(self, inputFile, spacingX, spacingY, spacingZ):
         """
         Run the actual algorithm
@@ -1110,6 +1048,23 @@ class MandibleNerveFlowLogic(ScriptedLoadableModuleLogic):
         annotationLogic = slicer.modules.annotations.logic()
         annotationLogic.CreateSnapShot(name, description, type, 1, imageData)
 
+    def keepIslands(self, mask, minimumSize=0):
+        # face connected islands of the mask, either the largest one or all of at least minimumSize voxels,
+        # the same connectivity the Islands effect uses
+        import SimpleITK as sitk  # deferred, loading ITK is slow and only segmentation needs it
+        islands = sitk.RelabelComponent(sitk.ConnectedComponent(sitk.GetImageFromArray(mask.astype(np.uint8))),
+                                        minimumSize)
+        labels = sitk.GetArrayViewFromImage(islands)
+        return labels == 1 if minimumSize == 0 else labels > 0
+
+    def fillOutsideSegment(self, segmentationNode, segmentID, volumeNode, maskedVolume, fillValue=-200):
+        # Blank out voxels that are outside the segment, written in place into the masked volume's voxel array
+        mask = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentID, volumeNode)
+        maskedVoxels = slicer.util.arrayFromVolume(maskedVolume)
+        maskedVoxels.fill(fillValue)
+        np.copyto(maskedVoxels, slicer.util.arrayFromVolume(volumeNode), where=mask != 0)
+        slicer.util.arrayFromVolumeModified(maskedVolume)
+
     def segmentSkull(self, segmentationNode, segmentEditorNode, segmentEditorWidget, volumeNode):
 
         segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
@@ -1165,6 +1120,17 @@ class MandibleNerveFlowLogic(ScriptedLoadableModuleLogic):
         segmentationNode.GetDisplayNode().SetSegmentVisibility(skullSegmentID, False)
         segmentationNode.GetDisplayNode().SetSegmentVisibility(headSegmentID, False)
 
+    def getExportedModels(self, exportFolderItemId):
+        # model nodes exported into the subject hierarchy folder, by name
+        shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+        childIds = vtk.vtkIdList()
+        shNode.GetItemChildren(exportFolderItemId, childIds)
+        models = {}
+        for i in range(childIds.GetNumberOfIds()):
+            modelNode = shNode.GetItemDataNode(childIds.GetId(i))
+            models[modelNode.GetName()] = modelNode
+        return models
+
     def initializeSegmentation(self, masterVolumeNode):
         # Create segmentation
         segmentationName = masterVolumeNode.GetName()
@@ -1203,6 +1169,38 @@ class MandibleNerveFlowLogic(ScriptedLoadableModuleLogic):
         else:
             return False
 
+    def getNextCell(self):
+        # text of the next visible row in the selected column
+        tableView = slicer.app.layoutManager().tableWidget(0).tableView()
+        if bool(tableView.selectedIndexes()):
+            index = tableView.selectedIndexes()[0]
+            tableNode = tableView.mrmlTableNode()
+            for row in range(index.row() + 1, tableNode.GetNumberOfRows() + 1):
+                if not tableView.isRowHidden(row):
+                    return tableNode.GetCellText(row - 1, index.column())
+        return ""
+
+    def prefetchFile(self, path):
+        # read the file on a background thread so a later import is served from the OS file cache,
+        # only the file is read there, no MRML or Qt objects are touched
+        if path == self.prefetchPath:
+            return
+        if self.prefetchThread is not None and self.prefetchThread.is_alive():
+            # one read at a time, the disk is not shared with a second one
+            return
+
+        def readFile():
+            try:
+                with open(path, "rb") as file:
+                    while file.read(1 << 24):
+                        pass
+            except OSError:
+                logging.debug("Prefetch of %s failed." % path)
+
+        self.prefetchPath = path
+        self.prefetchThread = threading.Thread(target=readFile, daemon=True)
+        self.prefetchThread.start()
+
     def runImport(self, volumePath):
         print(volumePath)
         properties = {'singleFile': True}
@@ -1226,63 +1224,39 @@ class MandibleNerveFlowLogic(ScriptedLoadableModuleLogic):
         table.GetTable().Modified()  # update table view
 
     # Frankfort alignment
-    def getFrankfortAlignment(self, poR, poL, zyoL):
-
-        po = [poR[0] - poL[0], poR[1] - poL[1], poR[2] - poL[2]]
-
-        vTransform = vtk.vtkTransform()
-        vTransform.RotateZ(-np.arctan2(po[1], po[0]) * 180 / np.pi)
-
-        po1 = vTransform.TransformPoint(poR)
-        po2 = vTransform.TransformPoint(poL)
-        zyo = vTransform.TransformPoint(zyoL)
-
-        po = [po1[0] - po2[0], po1[1] - po2[1], po1[2] - po2[2]]
-
-        vTransform2 = vtk.vtkTransform()
-        vTransform2.RotateY(np.arctan2(po[2], po[0]) * 180 / np.pi)
-
-        po1 = vTransform2.TransformPoint(po1)
-        po2 = vTransform2.TransformPoint(po2)
-        zyo = vTransform2.TransformPoint(zyo)
+    # rotation matrices with the same convention as vtkTransform.RotateX/Y/Z, angle in radians
+    def rotationX(self, angle):
+        c, s = np.cos(angle), np.sin(angle)
+        return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+    def rotationY(self, angle):
+        c, s = np.cos(angle), np.sin(angle)
+        return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+    def rotationZ(self, angle):
+        c, s = np.cos(angle), np.sin(angle)
+        return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+    def getPorionAlignment(self, poR, poL, v):
+        # rotate about Z then Y so the porion line runs along X, then about X so v lies in the XY plane
+        po = np.subtract(poR, poL)
+        rz = self.rotationZ(-np.arctan2(po[1], po[0]))
+        po = rz @ po
+        ryz = self.rotationY(np.arctan2(po[2], po[0])) @ rz
+        v = ryz @ v
+        rotation = self.rotationX(-np.arctan2(v[2], v[1])) @ ryz
+
+        matrix = np.identity(4)
+        matrix[:3, :3] = rotation
+        return slicer.util.vtkMatrixFromArray(matrix)
 
-        po_zyo = [zyo[0] - (po1[0] + po2[0]) / 2, zyo[1] - (po1[1] + po2[1]) / 2, zyo[2] - (po1[2] + po2[2]) / 2]
-
-        vTransform3 = vtk.vtkTransform()
-        vTransform3.RotateX(-np.arctan2(po_zyo[2], po_zyo[1]) * 180 / np.pi)
-
-        vTransform3.Concatenate(vTransform2)
-        vTransform3.Concatenate(vTransform)
-        return vTransform3.GetMatrix()
+    # Frankfort alignment
+    def getFrankfortAlignment(self, poR, poL, zyoL):
+        # zygoorbitale relative to the porion midpoint
+        return self.getPorionAlignment(poR, poL, np.subtract(zyoL, np.add(poR, poL) / 2))
 
     def getOSeAlignment(self, poR, poL, se, o):
-
-        po = [poR[0] - poL[0], poR[1] - poL[1], poR[2] - poL[2]]
-
-        vTransform = vtk.vtkTransform()
-        vTransform.RotateZ(-np.arctan2(po[1], po[0]) * 180 / np.pi)
-
-        po1 = vTransform.TransformPoint(poR)
-        po2 = vTransform.TransformPoint(poL)
-        se1 = vTransform.TransformPoint(se)
-        o1 = vTransform.TransformPoint(o)
-
-        po = [po1[0] - po2[0], po1[1] - po2[1], po1[2] - po2[2]]
-
-        vTransform2 = vtk.vtkTransform()
-        vTransform2.RotateY(np.arctan2(po[2], po[0]) * 180 / np.pi)
-
-        se1 = vTransform2.TransformPoint(se1)
-        o1 = vTransform2.TransformPoint(o1)
-
-        o_se = [se1[0] - o1[0], se1[1] - o1[1], se1[2] - o1[2]]
-
-        vTransform3 = vtk.vtkTransform()
-        vTransform3.RotateX(-np.arctan2(o_se[2], o_se[1]) * 180 / np.pi)
-
-        vTransform3.Concatenate(vTransform2)
-        vTransform3.Concatenate(vTransform)
-        return vTransform3.GetMatrix()
+        return self.getPorionAlignment(poR, poL, np.subtract(se, o))
 
 
 class MandibleNerveFlowTest(ScriptedLoadableModuleTest):